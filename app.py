@@ -3,22 +3,41 @@ import logging
 import time
 import asyncio
 import re
-# Import เครื่องมือสำหรับสร้างเว็บเซิร์ฟเวอร์และจัดการ JSON
-from flask import Flask, request, jsonify
+import json
+import threading
+import functools
+import hashlib
+import unicodedata
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+# Import เครื่องมือสำหรับสร้างเว็บเซิร์ฟเวอร์ (ASGI) และจัดการ JSON
+from quart import Quart, request, jsonify
 # Import เครื่องมือสำหรับ Telegram Bot (รับข้อความ, ส่งรูป, สร้างปุ่ม)
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes
 from telegram.ext.filters import TEXT as TEXT_FILTER
-# Import เครื่องมือ AI และ PDF
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+# Import เครื่องมือ AI
 import google.generativeai as genai
 # เพิ่มบรรทัดนี้เข้าไปในส่วน import ด้านบนสุดของไฟล์
-from google.api_core.exceptions import ResourceExhausted
-import pdfplumber
+from google.api_core.exceptions import ResourceExhausted, DeadlineExceeded
 # Import เครื่องมือฐานข้อมูล
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
+import httpx
+import redis.asyncio as redis
 # Import เครื่องมือโหลดค่า Config ในเครื่อง (ไม่ใช้บน Server จริง)
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
+# Import ระบบ Semantic Cache (จับคำถามที่ความหมายเหมือนกัน)
+from nvc_cache import SemanticCache
+# Import ตัวค้นหาคีย์เวิร์ด (Aho-Corasick) สำหรับคำถามที่พบบ่อย
+from nvc_keywords import KeywordMatcher
+# Import คลังรูปภาพ (แท็ก -> รูป + คำบรรยาย)
+from nvc_images import IMAGE_LOOKUP
+# Import ตัวเลือกข้อมูลวิทยาลัยเฉพาะส่วนที่เกี่ยวข้อง (Retrieval)
+from nvc_retrieval import ContextRetriever
 
 
 # 1. โหลดค่าความลับจากไฟล์ .env (ทำงานเฉพาะตอนรันบนคอมพิวเตอร์)
@@ -31,13 +50,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 3. สร้างแอป Flask (เว็บเซิร์ฟเวอร์)
-app = Flask(__name__)
+# 3. สร้างแอป Quart (เว็บเซิร์ฟเวอร์แบบ Async ใช้ Event Loop เดียวกับบอทตลอดอายุโปรแกรม)
+app = Quart(__name__)
 
 # 4. ดึงค่า Config จาก Environment Variables (กุญแจลับต่างๆ)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
 
 # --- ตรวจสอบความถูกต้องของกุญแจลับ (Safety Check) ---
 if not BOT_TOKEN:
@@ -46,11 +66,23 @@ if not BOT_TOKEN:
 
 
 
+# --- ตั้งค่า Gemini Model และ Context Caching ---
+# ⭐️ ใช้รุ่น Flash-Lite (เร็วและถูกที่สุดสำหรับถาม-ตอบสั้นๆ) เปลี่ยนได้ผ่าน GEMINI_MODEL
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
+CONTEXT_CACHE_TTL = timedelta(hours=1) # อายุของ Context Cache บนฝั่ง Gemini
+CONTEXT_CACHE_REFRESH_SECONDS = 20 * 60 # ต่ออายุ Cache ทุกๆ 20 นาที (ก่อนหมดอายุ)
+
 # ---  Class สำหรับจัดการ Key Rotation ---
 class GeminiKeyManager:
-    def __init__(self):
+    def __init__(self, system_instruction: str, context_prompt: str | None):
         self.keys = []
         self.current_index = 0
+        self.system_instruction = system_instruction
+        self.context_prompt = context_prompt
+        # Context Cache แยกตาม Key (Cache ที่สร้างด้วย Key หนึ่ง ใช้กับ Key อื่นไม่ได้)
+        self._caches = {}
+        self.context_cached = False
+        self._lock = threading.Lock()
         
         # 1. โหลด Key แบบรันเลข (GEMINI_API_KEY_1, _2, _3...)
         i = 1
@@ -69,8 +101,9 @@ class GeminiKeyManager:
             logger.info("✅ Found Single Default Key")
             
         if not self.keys:
-            logger.critical("!!! CRITICAL ERROR: No GEMINI_API_KEY found. Exiting. !!!")
-            exit(1)
+            # ไม่หยุดโปรแกรม: บอทยังตอบจาก FAQ / Cache ได้ ส่วนคำถามใหม่จะได้ข้อความแจ้งระบบไม่พร้อม
+            logger.critical("!!! CRITICAL ERROR: No GEMINI_API_KEY found. Gemini features disabled. !!!")
+            return
             
         logger.info(f"Loaded {len(self.keys)} Gemini API Keys.")
         self._configure_current_key()
@@ -79,98 +112,427 @@ class GeminiKeyManager:
 
     def _configure_current_key(self):
         """ตั้งค่า GenAI ด้วย Key ปัจจุบัน"""
+        if not self.keys: return
         current_key = self.keys[self.current_index]
         genai.configure(api_key=current_key)
-        # ⭐️ ใช้รุ่น 1.5 Flash (เสถียรสุด)
-        self.model = genai.GenerativeModel('gemini-2.5-flash') 
-        logger.info(f"Switched to Gemini Key Index: {self.current_index + 1}/{len(self.keys)}")
 
-    def rotate_key(self):
-        """สลับไปใช้ Key ถัดไป"""
-        self.current_index = (self.current_index + 1) % len(self.keys)
-        self._configure_current_key()
+        # ⭐️ ใช้ Context Cache (ส่งข้อมูลวิทยาลัย + คำสั่งระบบ ไปเก็บไว้ฝั่ง Gemini ครั้งเดียว)
+        cached_content = self._get_or_create_cache()
+        if cached_content:
+            self.model = genai.GenerativeModel.from_cached_content(cached_content)
+            self.context_cached = True
+        else:
+            # Fallback: ถ้าสร้าง Cache ไม่ได้ ให้ส่งข้อมูลวิทยาลัยไปพร้อมทุกคำถามเหมือนเดิม
+            self.model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=self.system_instruction)
+            self.context_cached = False
+        logger.info(f"Switched to Gemini Key Index: {self.current_index + 1}/{len(self.keys)} (context cached: {self.context_cached})")
+
+    def _get_or_create_cache(self):
+        """ดึง Context Cache ของ Key ปัจจุบัน (สร้างใหม่ถ้ายังไม่มี หรือหมดอายุแล้ว)"""
+        if not self.context_prompt: return None # ไม่มีข้อมูลคงที่ให้ Cache (ใช้ Retrieval แนบข้อมูลไปกับคำถามแทน)
+        cached_content = self._caches.get(self.current_index)
+        if cached_content and cached_content.expire_time > datetime.now(timezone.utc) + timedelta(minutes=1):
+            return cached_content
+        try:
+            cached_content = genai.caching.CachedContent.create(
+                model=f'models/{GEMINI_MODEL_NAME}',
+                display_name='nvc-context',
+                system_instruction=self.system_instruction,
+                contents=[self.context_prompt],
+                ttl=CONTEXT_CACHE_TTL,
+            )
+            self._caches[self.current_index] = cached_content
+            logger.info(f"Created Gemini context cache: {cached_content.name}")
+            return cached_content
+        except Exception as e:
+            logger.error(f"Error creating Gemini context cache: {e}. Sending context with every prompt.")
+            self._caches.pop(self.current_index, None)
+            return None
+
+    def refresh_cache(self):
+        """ต่ออายุ Context Cache ของ Key ปัจจุบัน (ถ้าต่อไม่ได้ ให้สร้างใหม่)"""
+        with self._lock:
+            cached_content = self._caches.get(self.current_index)
+            try:
+                if cached_content:
+                    cached_content.update(ttl=CONTEXT_CACHE_TTL)
+                    logger.info(f"Refreshed Gemini context cache TTL: {cached_content.name}")
+                    return
+            except Exception as e:
+                logger.warning(f"Error refreshing Gemini context cache: {e}. Recreating...")
+                self._caches.pop(self.current_index, None)
+            self._configure_current_key()
+
+    def rotate_key(self, failed_index: int | None = None):
+        """
+        สลับไปใช้ Key ถัดไป (มีการเรียก Gemini API เพื่อสร้าง Context Cache จึงต้องเรียกผ่าน rotate_key_async จาก Event Loop)
+        failed_index: Key ที่เจอ Error ถ้ามีคำขออื่นสลับ Key ไปแล้ว จะไม่สลับซ้ำ (กันข้าม Key ที่ยังใช้ได้)
+        """
+        with self._lock:
+            if failed_index is not None and failed_index != self.current_index:
+                return
+            self.current_index = (self.current_index + 1) % len(self.keys)
+            self._configure_current_key()
+
+    async def rotate_key_async(self, failed_index: int | None = None):
+        """สลับ Key ใน Thread แยก ไม่ให้ Event Loop ค้างระหว่างสร้าง Context Cache ของ Key ใหม่"""
+        await asyncio.to_thread(self.rotate_key, failed_index)
 
     def get_model(self):
         return self.model
 
-# สร้างตัวจัดการ Key (ใช้ตัวแปรนี้แทน gemini_model ตัวเก่า)
-key_manager = GeminiKeyManager()
+    def set_context_prompt(self, context_prompt: str | None):
+        """เปลี่ยนข้อมูลคงที่ที่ส่งให้ Gemini (สร้าง Context Cache ใหม่ตามข้อมูลนั้น)"""
+        with self._lock:
+            self.context_prompt = context_prompt
+            self._caches.clear()
+            self._configure_current_key()
+
+    def build_contents(self, prompt: str) -> list:
+        """
+        สร้าง contents ที่จะส่งให้ Gemini (แนบข้อมูลวิทยาลัยเฉพาะกรณีที่ไม่มี Context Cache)
+        ข้อมูลที่คงที่ต้องอยู่ "ด้านหน้า" เสมอ ส่วนที่เปลี่ยนทุกครั้งอยู่ท้ายสุด เพื่อให้ Gemini ทำ Implicit Caching ได้
+        """
+        if self.context_cached or not self.context_prompt:
+            return [prompt]
+        return [self.context_prompt, prompt]
+
+def _context_cache_refresh_loop():
+    """Background Thread: ต่ออายุ Context Cache ก่อนหมดอายุ เพื่อให้ Cache อุ่นอยู่ตลอด"""
+    while True:
+        time.sleep(CONTEXT_CACHE_REFRESH_SECONDS)
+        key_manager.refresh_cache()
 
 # 6. เชื่อมต่อฐานข้อมูล Supabase (ความจำระยะยาว)
-supabase: Client | None = None
-if SUPABASE_URL and SUPABASE_KEY:
+# ใช้ HTTP Client ตัวเดียวตลอดอายุโปรแกรม (HTTP/2 + Keep-Alive) เพื่อไม่ต้องเปิด TCP/TLS ใหม่ทุกคำสั่ง
+SUPABASE_HTTP_TIMEOUT = 10.0 # วินาที
+supabase_http = httpx.Client(
+    http2=True,
+    timeout=SUPABASE_HTTP_TIMEOUT,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=30.0),
+)
+supabase: Client | None = None # สร้างใน init_services()
+
+def _init_supabase():
+    global supabase
+    if SUPABASE_URL and SUPABASE_KEY:
+        try:
+            supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=supabase_http))
+            logger.info("Supabase client created successfully.")
+        except Exception as e:
+            logger.error(f"Error connecting to Supabase: {e}. Supabase features disabled.")
+            supabase = None
+    else:
+        logger.warning("Supabase credentials not found. Features disabled.")
+
+# 7. Semantic Cache (โหลดโมเดล Embedding ใน init_services() ครั้งเดียวตอนเริ่ม Server)
+semantic_cache = SemanticCache()
+
+# 8. ความจำระยะสั้น (ประวัติแชทล่าสุด) เก็บใน Redis เพื่อความเร็ว (Supabase เก็บถาวรแบบเบื้องหลัง)
+HISTORY_MAX_ITEMS = 16 # เก็บประวัติล่าสุดต่อแชทไว้กี่ข้อความ
+HISTORY_TOKEN_BUDGET = 512 # จำนวน Token สูงสุดของประวัติที่ส่งให้ Gemini (ประมาณด้วย estimate_tokens)
+REDIS_TIMEOUT_SECONDS = 1 # Redis ไม่ตอบภายในเวลานี้ -> ใช้ประวัติใน Memory แทน (ไม่ถ่วงเวลาก่อนเรียก Gemini)
+redis_client: redis.Redis | None = None # สร้างใน init_services()
+
+def _init_redis():
+    global redis_client
+    if REDIS_URL:
+        try:
+            redis_client = redis.from_url(
+                REDIS_URL,
+                decode_responses=True,
+                socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+                socket_timeout=REDIS_TIMEOUT_SECONDS,
+            )
+            logger.info("Redis client created successfully.")
+        except Exception as e:
+            logger.error(f"Error connecting to Redis: {e}. Using in-process history.")
+            redis_client = None
+    else:
+        logger.warning("REDIS_URL not found. Using in-process history.")
+# Fallback: ถ้าไม่มี Redis ให้เก็บประวัติไว้ใน Memory ของโปรเซส (หายเมื่อรีสตาร์ท)
+local_history: dict[str, deque] = defaultdict(lambda: deque(maxlen=HISTORY_MAX_ITEMS))
+
+# เก็บ Reference ของงานเบื้องหลังไว้ ไม่ให้ถูก Garbage Collect ระหว่างทำงาน
+background_tasks: set[asyncio.Task] = set()
+
+def fire_and_forget(coro) -> asyncio.Task:
+    """สั่งงานให้ทำเบื้องหลังโดยไม่ต้องรอผล"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# supabase-py เป็นแบบ Blocking: ทุกคำสั่งที่คุยกับ Supabase ต้องรันใน Thread Pool นี้ ไม่ให้ Event Loop ค้าง
+_db_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="supabase")
+
+async def run_db(func, *args):
+    """รันฟังก์ชันที่คุยกับ Supabase (แบบ Blocking) ใน Thread Pool แล้วรอผลแบบ Async"""
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, functools.partial(func, *args))
+
+# 9. คิวสำหรับบันทึกประวัติแชทลง Supabase แบบรวมเป็นชุด (Batch) แทนการ INSERT ทีละแถว
+CHAT_LOG_BATCH_SIZE = 50 # จำนวนแถวสูงสุดต่อการ INSERT หนึ่งครั้ง
+CHAT_LOG_FLUSH_INTERVAL = 3.0 # รอรวมแถวได้นานสุดกี่วินาทีก่อนส่ง
+CHAT_LOG_MAX_BUFFER = 1000 # ถ้าคิวเต็ม (เช่น Supabase ล่ม) จะทิ้งแถวที่เก่าที่สุด
+_chat_log_queue: asyncio.Queue = asyncio.Queue(maxsize=CHAT_LOG_MAX_BUFFER)
+
+# --- ส่วนฟังก์ชันช่วยเหลือ (Helper Functions) ---
+
+def _insert_chat_history(rows: list[dict]):
+    """บันทึกข้อความหลายแถวลงในตาราง chat_history ของ Supabase ในคำสั่งเดียว (เก็บถาวร)"""
+    if not supabase or not rows: return
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-        logger.info("Supabase client created successfully.")
+        supabase.table('chat_history').insert(rows).execute()
     except Exception as e:
-        logger.error(f"Error connecting to Supabase: {e}. Supabase features disabled.")
-        supabase = None
-else:
-    logger.warning("Supabase credentials not found. Features disabled.")
+        logger.error(f"Error saving chat history ({len(rows)} rows): {e}")
+
+def _enqueue_chat_log(data: dict):
+    """ใส่แถวประวัติแชทลงคิว (ไม่รอ) ถ้าคิวเต็มให้ทิ้งแถวที่เก่าที่สุด"""
+    if _chat_log_queue.full():
+        _chat_log_queue.get_nowait()
+        logger.warning("Chat log buffer full. Dropped oldest row.")
+    _chat_log_queue.put_nowait(data)
+
+def _drain_chat_log_queue() -> list[dict]:
+    """ดึงแถวที่ค้างอยู่ในคิวออกมาทั้งหมดโดยไม่รอ"""
+    rows = []
+    while not _chat_log_queue.empty():
+        rows.append(_chat_log_queue.get_nowait())
+    return rows
+
+async def flush_chat_log_loop():
+    """
+    Background Task: รวมแถวจากคิวแล้ว INSERT ลง Supabase ทีละชุด
+    ส่งเมื่อครบ CHAT_LOG_BATCH_SIZE แถว หรือรอครบ CHAT_LOG_FLUSH_INTERVAL วินาที
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        rows = [await _chat_log_queue.get()]
+        deadline = loop.time() + CHAT_LOG_FLUSH_INTERVAL
+        try:
+            while len(rows) < CHAT_LOG_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0: break
+                try:
+                    rows.append(await asyncio.wait_for(_chat_log_queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # ถูกสั่งปิดระหว่างรอรวมชุด: บันทึกแถวที่ดึงออกมาแล้วก่อนจบการทำงาน
+            await run_db(_insert_chat_history, rows)
+            raise
+        await run_db(_insert_chat_history, rows)
 
-# --- ส่วนฟังก์ชันช่วยเหลือ (Helper Functions) ---
+# ชื่อผู้ใช้ล่าสุดที่บันทึกลงตาราง users แล้ว (chat_id -> username) เขียนใหม่เฉพาะตอนชื่อเปลี่ยน
+_known_usernames: dict[str, str] = {}
 
-def save_chat_history(chat_id: int, sender: str, message: str, username: str = None):
+def _upsert_user(chat_id: str, username: str):
+    """บันทึก/อัปเดตชื่อผู้ใช้ลงตาราง users (ประวัติแชทเก็บแค่ chat_id ไม่ต้องเก็บชื่อซ้ำทุกแถว)"""
+    try:
+        supabase.table('users').upsert({"chat_id": chat_id, "username": username}, on_conflict='chat_id').execute()
+    except Exception as e:
+        logger.error(f"Error saving user: {e}")
+        _known_usernames.pop(chat_id, None) # ให้ลองใหม่ครั้งหน้า
+
+def remember_user(chat_id: int, username: str | None):
+    """อัปเดตชื่อผู้ใช้ในตาราง users เบื้องหลัง (เฉพาะครั้งแรก หรือเมื่อชื่อเปลี่ยน)"""
+    if not supabase or not username: return
+    chat_key = str(chat_id)
+    if _known_usernames.get(chat_key) == username: return
+    _known_usernames[chat_key] = username
+    fire_and_forget(run_db(_upsert_user, chat_key, username))
+
+async def save_chat_turn(chat_id: int, entries: list[tuple[str, str]], username: str = None):
     """
-    บันทึกข้อความลงในตาราง chat_history ของ Supabase
+    บันทึกข้อความหลายข้อความของการคุย 1 รอบ (เช่น คำถาม + คำตอบ) ลงประวัติแชทในครั้งเดียว
+    entries: รายการ (sender, message) เรียงจากเก่า -> ใหม่ โดย sender คือ 'user' หรือ 'bot'
+    เขียนลง Redis (หรือ Memory) ทันที ส่วน Supabase เขียนเบื้องหลังโดยไม่ต้องรอ
+    """
+    remember_user(chat_id, username)
+    rows = [
+        {"chat_id": str(chat_id), "sender": sender, "message": message}
+        for sender, message in entries
+    ]
+    try:
+        if redis_client:
+            # ใช้ Pipeline ส่ง LPUSH (ทุกข้อความ) + LTRIM ในรอบเดียว (เก็บเป็น List แบบจำกัดความยาว)
+            key = f"hist:{chat_id}"
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.lpush(key, *(json.dumps(row, ensure_ascii=False) for row in rows))
+                pipe.ltrim(key, 0, HISTORY_MAX_ITEMS - 1)
+                await pipe.execute()
+        else:
+            local_history[str(chat_id)].extend(rows)
+    except Exception as e:
+        logger.error(f"Error saving short-term history: {e}")
+        local_history[str(chat_id)].extend(rows)
+
+    # Write-behind: ใส่คิวไว้ แล้วให้ flush_chat_log_loop บันทึกลง Supabase เป็นชุด (ไม่ถ่วงเวลาตอบผู้ใช้)
+    if supabase:
+        for row in rows:
+            _enqueue_chat_log(row)
+
+async def save_chat_history(chat_id: int, sender: str, message: str, username: str = None):
+    """
+    บันทึกข้อความเดียวลงประวัติแชท
     sender: 'user' (ผู้ใช้) หรือ 'bot' (บอทตอบ)
     """
-    if not supabase: return
+    await save_chat_turn(chat_id, [(sender, message)], username)
+
+def _fetch_recent_chat_history(chat_id: str, limit: int) -> list[dict]:
+    """ดึงประวัติแชทล่าสุดจากตาราง chat_history ของ Supabase (เรียงใหม่ -> เก่า)"""
+    response = supabase.table('chat_history').select('sender, message') \
+        .eq('chat_id', chat_id) \
+        .order('created_at', desc=True) \
+        .limit(limit) \
+        .execute()
+    return response.data or []
+
+async def _hydrate_chat_history(chat_id: int) -> list[dict]:
+    """
+    แชทที่ยังไม่มีประวัติใน Redis / Memory (เช่น หลังรีสตาร์ทโปรแกรมที่ไม่มี Redis): ดึงประวัติล่าสุดจาก Supabase
+    แล้วเติมลงที่เก็บระยะสั้น ครั้งต่อไปจะได้ไม่ต้องถาม Supabase อีก คืนรายการที่ดึงมา (เรียงเก่า -> ใหม่)
+    """
+    if not supabase: return []
+    chat_key = str(chat_id)
     try:
-        data = {
-            "chat_id": str(chat_id),
-            "sender": sender,
-            "message": message,
-            "username": username
-        }
-        supabase.table('chat_history').insert(data).execute()
+        rows = await run_db(_fetch_recent_chat_history, chat_key, HISTORY_MAX_ITEMS)
     except Exception as e:
-        logger.error(f"Error saving chat history: {e}")
+        logger.error(f"Error loading chat history from Supabase: {e}")
+        return []
+    if not rows: return []
 
-def get_chat_history(chat_id: int, limit: int = 6) -> str:
+    items = [{"chat_id": chat_key, "sender": row['sender'], "message": row['message']} for row in reversed(rows)]
+    if redis_client:
+        try:
+            # Redis เก็บแบบใหม่ -> เก่า: RPUSH ต่อท้ายตามลำดับ (ถ้ามีข้อความใหม่ถูก LPUSH เข้ามาระหว่างนี้ ลำดับก็ยังถูก)
+            key = f"hist:{chat_id}"
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.rpush(key, *(json.dumps(item, ensure_ascii=False) for item in reversed(items)))
+                pipe.ltrim(key, 0, HISTORY_MAX_ITEMS - 1)
+                await pipe.execute()
+            return items
+        except Exception as e:
+            logger.error(f"Error seeding Redis history: {e}. Using in-process history.")
+    # ข้อความที่อาจถูกเพิ่มเข้ามาระหว่างรอ Supabase ต้องอยู่หลังประวัติเก่า
+    newer = list(local_history.get(chat_key, ()))
+    local_history[chat_key] = deque(items + newer, maxlen=HISTORY_MAX_ITEMS)
+    return items
+
+async def _read_short_term_history(chat_id: int, limit: int) -> list[dict]:
+    """อ่านประวัติล่าสุดจาก Redis (เรียงเก่า -> ใหม่) ถ้า Redis ใช้ไม่ได้ให้อ่านจาก Memory ที่ save_chat_turn เขียนสำรองไว้"""
+    if redis_client:
+        try:
+            # Redis เก็บแบบใหม่ -> เก่า จึงต้องกลับลำดับ
+            raw_items = await redis_client.lrange(f"hist:{chat_id}", 0, limit - 1)
+            return [json.loads(raw) for raw in reversed(raw_items)]
+        except Exception as e:
+            logger.error(f"Error reading Redis history: {e}. Using in-process history.")
+    return list(local_history.get(str(chat_id), ()))[-limit:]
+
+def estimate_tokens(text: str) -> int:
+    """ประมาณจำนวน Token: อักษรอังกฤษ/ตัวเลข ~4 ตัว = 1 Token, ภาษาไทยและอักขระอื่น ~2 ตัว = 1 Token (ปัดขึ้น)"""
+    ascii_chars = sum(1 for ch in text if ch < '\x80')
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars + 1) // 2
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """ตัดข้อความ (เก็บส่วนต้นไว้ + "…") ให้ไม่เกิน max_tokens"""
+    if estimate_tokens(text) <= max_tokens: return text
+    cut = min(len(text), max_tokens * 4)
+    while cut > 0 and estimate_tokens(text[:cut] + "…") > max_tokens:
+        cut -= 1
+    return text[:cut] + "…" if cut else ""
+
+async def get_chat_history(chat_id: int, limit: int = 6) -> str:
     """
     ดึงประวัติการแชทล่าสุด 6 ข้อความ (3 คู่สนทนา) เพื่อส่งให้ Gemini
     ช่วยให้ AI จำบริบทการคุยต่อเนื่องได้
+    อ่านจาก Redis / Memory ก่อน ถ้ายังไม่มีประวัติของแชทนี้ (Cold Start) จะดึงจาก Supabase มาเติมให้
     """
-    if not supabase: return ""
     try:
-        response = supabase.table('chat_history').select('sender, message') \
-            .eq('chat_id', str(chat_id)) \
-            .order('created_at', desc=True) \
-            .limit(limit) \
-            .execute()
-        
-        if not response.data: return ""
-
-        # จัดรูปแบบข้อความย้อนหลัง (เรียงจากเก่า -> ใหม่)
-        formatted_history = "\n--- Chat History (Oldest to Newest) ---\n"
-        for item in reversed(response.data): 
-            formatted_history += f"[{item['sender'].upper()}]: {item['message']}\n"
-        formatted_history += "--- End Chat History ---\n"
-        return formatted_history
+        items = await _read_short_term_history(chat_id, limit)
+        if not items:
+            items = (await _hydrate_chat_history(chat_id))[-limit:]
+        if not items: return ""
+
+        # เลือกข้อความจากใหม่ -> เก่า จนกว่าจะเต็มงบ Token (ข้อความยาวๆ จะไม่ทำให้ Prompt บวม)
+        # และยุบช่องว่างให้เหมือนกันทุกครั้ง เพื่อให้ Prompt ที่เหมือนกันได้ประโยชน์จาก Cache ของ Gemini
+        token_budget = HISTORY_TOKEN_BUDGET
+        lines = []
+        for item in reversed(items):
+            message = re.sub(r'\s+', ' ', item['message']).strip()
+            line = f"[{item['sender'].upper()}]: {message}"
+            if not lines:
+                # ข้อความล่าสุดต้องอยู่เสมอ: ถ้ายาวเกินงบ (เช่น คำตอบภาษาไทยยาวๆ) ให้ตัดส่วนท้ายออก ไม่ทิ้งประวัติทั้งหมด
+                line = truncate_to_tokens(line, token_budget)
+            token_budget -= estimate_tokens(line)
+            if token_budget < 0: break
+            lines.append(line)
+        if not lines: return ""
+
+        # จัดรูปแบบข้อความย้อนหลัง (เรียงจากเก่า -> ใหม่) ต่อกันครั้งเดียวด้วย join
+        return "\n--- Chat History (Oldest to Newest) ---\n" + "\n".join(reversed(lines)) + "\n--- End Chat History ---\n"
     except Exception as e:
         logger.error(f"Error fetching history: {e}")
         return ""
 
 
+# --- Cache แบบตรงตัว ในหน่วยความจำ (LRU + TTL) ---
+# ดักคำถามเดิมที่พิมพ์ซ้ำ ก่อนจะต้องไปถาม Supabase / คำนวณ Embedding
+EXACT_CACHE_MAX_ENTRIES = 2000
+EXACT_CACHE_TTL = 300 # อายุคำตอบในหน่วยความจำ (วินาที) หมดแล้วจะไปเช็คที่ Supabase ใหม่
+EXACT_CACHE_STATS_EVERY = 100 # Log สถิติ Hit/Miss ทุกกี่ครั้งที่ค้นหา
+_exact_cache: TTLCache = TTLCache(maxsize=EXACT_CACHE_MAX_ENTRIES, ttl=EXACT_CACHE_TTL)
+_exact_cache_lock = threading.Lock() # save_to_cache เขียนจาก Thread ของ DB จึงต้องล็อก
+exact_cache_stats = {'hits': 0, 'misses': 0}
+
+def normalize_message(message: str) -> str:
+    """ทำข้อความให้อยู่ในรูปมาตรฐาน (NFKC + ตัวพิมพ์เล็ก + ยุบช่องว่าง) เพื่อใช้เป็น Key ของ Cache"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize("NFKC", message).strip().casefold())
+
+def message_hash(message: str) -> str:
+    """
+    Key ของ Cache ใน Supabase: md5 ของ (เวอร์ชันข้อมูลวิทยาลัย + ข้อความมาตรฐาน)
+    สั้นและขนาดคงที่ ทำ Index ได้ดีกว่าข้อความเต็ม และเมื่อแก้ไฟล์ข้อมูล คำตอบเก่าจะไม่ถูกนำมาใช้อีก
+    """
+    return hashlib.md5(f"{CONTEXT_VERSION}:{normalize_message(message)}".encode('utf-8')).hexdigest()
+
+def get_exact_cached(message: str) -> str | None:
+    """ค้นหาคำตอบจาก Cache ในหน่วยความจำ (ไม่เจอ หรือหมดอายุ คืนค่า None)"""
+    key = normalize_message(message)
+    with _exact_cache_lock:
+        response = _exact_cache.get(key)
+        exact_cache_stats['hits' if response is not None else 'misses'] += 1
+        total = exact_cache_stats['hits'] + exact_cache_stats['misses']
+    if total % EXACT_CACHE_STATS_EVERY == 0:
+        logger.info(f"📊 Memory cache stats: {exact_cache_stats['hits']} hits / {exact_cache_stats['misses']} misses")
+    return response
+
+def put_exact_cached(message: str, response: str):
+    """บันทึกคำตอบลง Cache ในหน่วยความจำ (ลบรายการที่ไม่ได้ใช้นานที่สุดทิ้งเมื่อเต็ม)"""
+    key = normalize_message(message)
+    with _exact_cache_lock:
+        _exact_cache[key] = response
+
+
 def get_cached_response(message: str):
     """ค้นหาคำตอบใน Cache """
     if not supabase: return None
     
     try:
         clean_message = message.strip()
-        response = supabase.table('response_cache') \
-            .select('bot_response') \
-            .eq('user_message', clean_message) \
-            .limit(1) \
-            .execute()
-            # .gt() ย่อมาจาก Greater Than (มากกว่า/ใหม่กว่า)
-            
+        # RPC: Postgres เลือกเฉพาะคำตอบที่อายุไม่เกิน 24 ชั่วโมงให้เอง (ดู supabase/migrations)
+        response = supabase.rpc('get_fresh_cached', {'p_hash': message_hash(clean_message)}).execute()
+
         if response.data:
-            logger.info(f"Cache HIT (Fresh) for: {clean_message}")
-            return response.data[0]['bot_response']
+            # ไม่ Log ข้อความของผู้ใช้ทุกข้อความที่ระดับ INFO (handle_message Log ผลการใช้ Cache ไว้แล้ว)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Cache HIT (Fresh) for: {clean_message}")
+            put_exact_cached(clean_message, response.data)
+            return response.data
         else:
-            logger.info(f"Cache MISS (Expired or Not Found) for: {clean_message}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Cache MISS (Expired or Not Found) for: {clean_message}")
             return None # ถ้าไม่เจอ หรือเจอแต่เก่าเกินไป จะส่งกลับเป็น None (ให้ Gemini คิดใหม่)
             
     except Exception as e:
@@ -183,18 +545,37 @@ def save_to_cache(message: str, response: str):
     ระบบ Cache: บันทึกคำถามใหม่และคำตอบลงฐานข้อมูล
     เพื่อใช้ตอบคนอื่นในอนาคต
     """
+    put_exact_cached(message, response) # เขียนลง Cache ในหน่วยความจำด้วย (Write-through)
     if not supabase: return
     try:
         clean_message = message.strip()
         # ไม่บันทึกถ้าข้อความสั้นเกินไป หรือยาวเกินไป
         if len(clean_message) < 2 or len(clean_message) > 200: return
 
-        data = {"user_message": clean_message, "bot_response": response}
-        supabase.table('response_cache').insert(data).execute()
-        logger.info(f"Saved to cache: {clean_message}")
+        # ค้นหาด้วย msg_hash เท่านั้น ส่วน user_message เก็บไว้ดูย้อนหลัง
+        data = {"msg_hash": message_hash(clean_message), "user_message": clean_message, "bot_response": response}
+        # UPSERT: ถ้ามีคำถามนี้อยู่แล้วให้อัปเดตคำตอบ (ต้องมี Unique Index ตาม supabase/migrations)
+        supabase.table('response_cache').upsert(data, on_conflict='msg_hash').execute()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Saved to cache: {clean_message}")
     except Exception as e:
         logger.error(f"Error saving to cache: {e}")
 
+def normalize_context(text: str) -> str:
+    """
+    ตัดช่องว่างส่วนเกินของข้อมูลบริบท (ช่องว่างซ้ำ, ช่องว่างท้ายบรรทัด, บรรทัดว่างติดกันหลายบรรทัด)
+    ทำครั้งเดียวตอนโหลด ลดจำนวน Token ที่ส่งให้ Gemini โดยเนื้อหาไม่เปลี่ยน
+    """
+    text = re.sub(r'[ \t\u00a0]+', ' ', text)
+    text = "\n".join(line.strip() for line in text.splitlines())
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+@functools.lru_cache(maxsize=1)
+def _load_context(file_path: str, mtime: float) -> str:
+    """อ่านไฟล์จริงจากดิสก์ (Cache ไว้ตาม mtime: อ่านใหม่เฉพาะตอนไฟล์ถูกแก้ไข)"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return normalize_context(f.read())
+
 def read_txt_context(file_path):
     """
     อ่านข้อมูลบริบทจากไฟล์ .txt (เช่น ข้อมูลวิทยาลัย)
@@ -203,138 +584,520 @@ def read_txt_context(file_path):
         logger.error(f"Context file not found: {file_path}")
         return "ไม่พบข้อมูลบริบท"
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        return _load_context(file_path, os.path.getmtime(file_path))
     except Exception as e:
         logger.error(f"Error reading context file: {e}")
         return "เกิดข้อผิดพลาดในการอ่านข้อมูลบริบท"
 
 # --- ข้อมูลและคำสั่ง (Configuration Data) ---
 
-# คลังรูปภาพ: เชื่อมโยง 'แท็ก' (เช่น building_1) กับ 'URL รูปภาพ'
-IMAGE_LOOKUP = {
-    'map': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/map.png', 'แผนที่วิทยาลัยอาชีวศึกษานครศรีธรรมราช'),
-    'pang': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/pang.png', 'ผังอาคารของวิทยาลัยอาชีวศึกษานครศรีธรรมราช'),
-    'pp': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/pp.jpg', 'การผ่อนผันทหาร'),
-    'QU': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/QU.jpg', 'ประกาศรับสมัคร ป.ตรี'),
-
-
-    'DBT': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DBT.png', 'บุคลากรแผนกวิชาเทคโนโลยีธุรกิจดิจิทัล'),
-    'DeoGl': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoGl.png', 'บุคลากรแผนกวิชาสามัญ'),
-    'DeoF': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoF.png', 'บุคลากรแผนกอาหารและโภชนาการ'),
-    'DeoHEc': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoHEc.png', 'บุคลากรแผนกวิชาคหกรรมศาสตร์'),
-    'DeoFaAT': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoFaAT.png', 'บุคลากรแผนกวิชาเทคโนโลยีแฟชั่นและเครื่องแต่งกาย'),
-    'Ac': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/Ac.png', 'บุคลากรแผนกวิชาการบัญชี'),
-    'MkD': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/MkD.png', 'บุคลากรแผนกวิชาการตลาด'),
-    'Desom': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/Desom.png', 'บุคลากรแผนกวิชาการจัดการสำนักงานดิจิทัล'),
-    'DeoLaSCM': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoLaSCM.png', 'บุคลากรแผนกวิชาการจัดการธุรกิจ/แผนกวิชาการจัดการโลจิสติกส์และซัพพลายเซน'),
-    'HDe': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/HDe.png', 'บุคลากรแผนกวิชาการโรงแรม'),
-    'DeoTBM': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoTBM.png', 'บุคลากรแผนกวิชาการจัดการธุรกิจท่องเที่ยว'),
-    'DeoTBMa': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoTBMa.png', 'บุคลากรแผนกวิชาภาษาต่างประเทศ'),
-    'ITD': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/ITD.png', 'บุคลากรแผนกวิชาเทคโนโลยีสารสนเทศ'),
-    'DeoLI': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoLI.png', 'บุคลากรแผนกวิชาอุตสาหกรรมโลจิสติกส์'),
-
-    # ตัวอย่างการส่งหลายรูป (Album)
-    'quota_round_1': (
-        [
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Report.jpg',
-            
-        ], 
-        'เอกสารรายงานตัว'
-    ),
-    'quota_round_2': (
-        [
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/QOU1.jpg',
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/QU.jpg'
-        ], 
-        '📝 การรับสมัคร โควตากรณีพิเศษ (รอบที่ 1) ปีการศึกษา 2569'
-    ),
-    'quota_round_3': (
-        [
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply1.jpg',
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply2.jpg',
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply3.jpg',
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply4.jpg',
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply5.jpg',
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply6.jpg',
-            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply7.jpg',
+# คีย์เวิร์ดในคำถามของผู้ใช้ -> แท็กรูปภาพ (ระบบเลือกรูปเอง ไม่ต้องให้ Gemini ใส่แท็ก)
+IMAGE_KEYWORDS = {
+    'map': ("แผนที่", "การเดินทาง", "เดินทางไป"),
+    'pang': ("ผังอาคาร", "ผังวิทยาลัย"),
+    'QU': ("สมัครปริญญาตรี", "การรับสมัครปริญญาตรี", "สมัคร ป.ตรี", "ปริญญาตรี รอบโควตา"),
+    'quota_round_1': ("รายงานตัว", "รอบโควตาพิเศษ", "โควตาพิเศษ"),
+    'quota_round_2': ("การรับสมัคร", "โควตากรณีพิเศษ"), # รวมปุ่ม "📝 การรับสมัครปวช./ปวส."
+    'quota_round_3': ("สมัครออนไลน์", "สมัครทางออนไลน์", "ขั้นตอนการสมัคร"),
+    'pp': ("ผ่อนผันทหาร", "ผ่อนผันเข้ารับราชการทหาร"),
+    'Birds-eye': ("ภาพมุมสูง", "มุมสูง"),
+    'certificate1': ("การแต่งกาย ปวช", "ชุด ปวช"),
+    'certificate2': ("การแต่งกาย ปวส", "ชุด ปวส"),
+    'Discipline': ("ระเบียบวินัย",),
+    'building_1': ("อาคาร 1", "อาคารอำนวยการ"),
+    'building_2': ("อาคาร 2",),
+    'building_3': ("อาคาร 3",),
+    'building_4': ("อาคาร 4",),
+    'building_5': ("อาคาร 5",),
+    'building_6': ("อาคาร 6",),
+    'building_7': ("อาคาร 7",),
+    'building_8': ("อาคาร 8",),
+    'building_6_632': ("ห้อง 632",),
+}
 
-            
-        ], 
-        'ขั้นตอนการสมัครเข้าศึกษาต่อ ระบบออนไลน์'
-    ),
+# ชื่อแผนก -> แท็กรูปบุคลากร (จับได้ทั้ง "ครูแผนก..." "ครูแผนกวิชา..." "บุคลากรแผนก..." "บุคลากรแผนกวิชา...")
+DEPARTMENT_IMAGE_TAGS = {
+    "เทคโนโลยีธุรกิจดิจิทัล": 'DBT',
+    "สามัญ": 'DeoGl',
+    "อาหารและโภชนาการ": 'DeoF',
+    "คหกรรมศาสตร์": 'DeoHEc',
+    "เทคโนโลยีแฟชั่นและเครื่องแต่งกาย": 'DeoFaAT',
+    "การบัญชี": 'Ac',
+    "การตลาด": 'MkD',
+    "การจัดการสำนักงานดิจิทัล": 'Desom',
+    "การจัดการธุรกิจ": 'DeoLaSCM',
+    "การจัดการโลจิสติกส์และซัพพลายเชน": 'DeoLaSCM',
+    "การจัดการโลจิสติกส์และซัพพลายเซน": 'DeoLaSCM', # สะกดแบบนี้ในคำบรรยายรูปและบางส่วนของ dataNVC.txt
+    "การโรงแรม": 'HDe',
+    "การจัดการธุรกิจท่องเที่ยว": 'DeoTBM',
+    "ภาษาต่างประเทศ": 'DeoTBMa',
+    "เทคโนโลยีสารสนเทศ": 'ITD',
+    "อุตสาหกรรมโลจิสติกส์": 'DeoLI',
+}
 
+def _build_image_matcher() -> KeywordMatcher:
+    """รวมคีย์เวิร์ดทั้งหมดเป็นตัวค้นหาเดียว (รองรับการพิมพ์แบบไม่เว้นวรรคด้วย เช่น "อาคาร1")"""
+    keywords = {}
+    for tag, words in IMAGE_KEYWORDS.items():
+        for word in words:
+            keywords[word] = tag
+    for department, tag in DEPARTMENT_IMAGE_TAGS.items():
+        for prefix in ("ครูแผนก", "ครูแผนกวิชา", "บุคลากรแผนก", "บุคลากรแผนกวิชา"):
+            keywords[prefix + department] = tag
+    for word, tag in list(keywords.items()):
+        keywords.setdefault(word.replace(" ", ""), tag)
+    return KeywordMatcher(keywords)
+
+image_matcher = _build_image_matcher()
+
+def match_image_tag(message: str) -> str | None:
+    """
+    เลือกแท็กรูปภาพจากคำถามของผู้ใช้
+    กฎ: เจอ "แค่ 1 หัวข้อ" -> ส่งรูปนั้น, เจอหลายหัวข้อ (เช่น ถามเปรียบเทียบ) -> ไม่ส่งรูป กันสแปม
+    """
+    tags = {tag for _, tag in image_matcher.find_longest(message)}
+    if len(tags) != 1: return None
+    return tags.pop()
+
+# ข้อความสั้นที่แทบจะเป็นแค่คีย์เวิร์ดรูป (เช่น "แผนที่", "ขอผังอาคาร"): ส่งรูปพร้อมคำบรรยายทันที ไม่ต้องถาม Gemini
+IMAGE_SHORTCUT_MAX_LENGTH = 25
+IMAGE_SHORTCUT_MIN_COVERAGE = 0.6 # คีย์เวิร์ดต้องยาวอย่างน้อย 60% ของข้อความ ("อาคาร 1 อยู่ไหน" ยังให้ Gemini ตอบ)
+
+def match_image_shortcut(message: str) -> str | None:
+    """คืนแท็กรูปถ้าข้อความสั้นและมีแค่คีย์เวิร์ดรูป 1 หัวข้อ (ไม่งั้นคืน None ให้ระบบตอบตามปกติ)"""
+    clean_message = message.strip().lower()
+    if not clean_message or len(clean_message) > IMAGE_SHORTCUT_MAX_LENGTH: return None
+
+    matches = image_matcher.find_longest(clean_message)
+    tags = {tag for _, tag in matches}
+    if len(tags) != 1: return None
+    if sum(len(kw) for kw, _ in matches) / len(clean_message) < IMAGE_SHORTCUT_MIN_COVERAGE: return None
+    return tags.pop()
+
+# คำสั่งระบบ (System Instruction): บุคลิก + กฎการตอบ (คงที่ ไม่เปลี่ยนตามคำถาม)
+SYSTEM_INSTRUCTION = """
+    คุณคือแชทบอทผู้เชี่ยวชาญด้านข้อมูลของวิทยาลัยอาชีวศึกษานครศรีธรรมราช (NVC Assistant)
+    ***
+    ### 🎯 ภารกิจและบุคลิกภาพ (Persona)
+    1.  **น้ำเสียง (Tone):** สุภาพ, เป็นมิตร, ตอบเป็นธรรมชาติเหมือนรุ่นพี่แนะนำรุ่นน้อง, และกระตือรือร้น
+    2.  **ขอบเขต:** ตอบคำถามโดยยึดตาม **"ข้อมูลบริบทของวิทยาลัย"** ที่ให้มาเท่านั้น
+    3.  **ความลื่นไหล:** สรุปใจความให้กระชับ อ่านง่าย ข้อความไม่ยาวจนเกินไป
+
+    ### 🖼️ รูปภาพ
+    ระบบจะส่งรูปภาพประกอบให้ผู้ใช้เอง ❌ **ห้าม** ใส่แท็กรูปภาพ (เช่น `[IMAGE:...]`) หรือลิงก์รูปภาพในคำตอบ
+
+    ### 📝 รูปแบบการจัดคำตอบ (Formatting)
+    1.  **Heading และ Bullet Points:** ใช้ตัวหนา (`**`) สำหรับหัวข้อ และใช้ `*` สำหรับรายการ เพื่อให้อ่านง่าย
+    2.  **เว้นวรรค:** เว้นบรรทัดระหว่างย่อหน้าเสมอ อย่าพิมพ์ติดกันเป็นพรืด
+
+    ### 🚨 การจัดการคำถามที่กว้างหรือกำกวม (Ambiguity Handling) - สำคัญมาก! ⭐️
+    หากคำถามของผู้ใช้ **กว้างมาก, ไม่เจาะจง** (เช่น "ขอข้อมูลวิทยาลัย", "มีแผนกอะไรบ้าง", "อยากเรียนต่อ"):
+    1.  ⛔️ **ห้าม** อธิบายรายละเอียดเนื้อหาทั้งหมดในทันที (เพื่อป้องกันข้อความยาวเกินไป)
+    2.  ✅ **ให้ตอบโดยการลิสต์ "หัวข้อ" หรือ "ทางเลือก"** สั้นๆ
+    3.  ✅ **ต้องจบประโยค** ด้วยการถามกลับเพื่อให้ผู้ใช้เลือกหัวข้อที่สนใจ
+
+    **ตัวอย่าง 1: เมื่อผู้ใช้ถามกว้างๆ เรื่องการสมัคร**
+    ผู้ใช้: "อยากสมัครเรียน"
+    บอท: "ยินดีต้อนรับครับ! 🎉 วิทยาลัยอาชีวศึกษานครศรีธรรมราช เปิดรับสมัครหลายรอบครับ เพื่อให้ข้อมูลที่ถูกต้อง รบกวนน้องระบุวุฒิปัจจุบันหน่อยครับ:
+    * จบ ม.3 -> เข้าต่อระดับ ปวช.
+    * จบ ม.6 / ปวช. -> เข้าต่อระดับ ปวส.
+    * จบ ปวส. -> เข้าต่อระดับ ปริญญาตรี
+    พิมพ์ระดับที่สนใจมาได้เลยครับ!"
+
+    **ตัวอย่าง 2: เมื่อผู้ใช้ไม่รู้จะเรียนอะไรดี**
+    ผู้ใช้: "เรียนสาขาอะไรดี" หรือ "แนะนำสาขาหน่อย"
+    บอท: "เพื่อให้น้องเลือกสาขาที่ใช่ที่สุด ลองบอกสิ่งที่ชอบหรือถนัดให้พี่รู้นิดนึงครับ เช่น:
+    * 💻 ชอบคอมพิวเตอร์/เทคโนโลยี
+    * 💰 ชอบตัวเลข
+    * 🍳 ชอบทำอาหาร
+    พิมพ์สิ่งที่ชอบมาสั้นๆ ได้เลยครับ เดี๋ยวพี่แนะนำสาขาที่เหมาะให้ครับ!"
+
+    ***
+
+    ### 🚨 ข้อจำกัดความปลอดภัย (Safety)
+    1.  ตอบ **เฉพาะข้อมูลที่มีในบริบท** เท่านั้น ห้ามแต่งเติมข้อมูลเองเด็ดขาด (No Hallucination)
+    2.  หากคำถามเกี่ยวข้องกับวิทยาลัย แต่ **ไม่มีข้อมูลในบริบท** ให้ตอบว่า "ขออภัยครับ ข้อมูลส่วนนี้พี่อาจจะยังไม่มี แนะนำให้ติดต่อสอบถามทางวิทยาลัยโดยตรง"
+    3.  หากคำถาม **ไม่เกี่ยวข้อง** กับวิทยาลัยเลย ให้แจ้งอย่างสุภาพว่าไม่สามารถตอบได้
+    """
 
-    # ... (เพิ่มรายการอื่นๆ ที่นี่)
-    'building_1': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/1.png', 'นี่คือภาพอาคาร 1 ครับ'),
-    'building_2': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/2.png', 'นี่คือภาพอาคาร 2 ครับ'),
-    'building_3': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/3.png', 'นี่คือภาพอาคาร 3 ครับ'),
-    'building_4': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/4.png', 'นี่คือภาพอาคาร 4 ครับ'),
-    'building_5': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/5.png', 'นี่คือภาพอาคาร 5 ครับ'),
-    'building_6': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/6.png', 'นี่คือภาพอาคาร 6 ครับ'),
-    'building_7': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/7.png', 'นี่คือภาพอาคาร 7 ครับ'),
-    'building_8': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/8.png', 'นี่คือภาพอาคาร 8 ครับ'),
-    'building_6_632': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/IMG_20251117_132117.jpg', 'นี่คือห้อง 632 ครับ'),
-    # ...
-
-    'Birds-eye': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Birds-eyeview.png','นี่คือห้องภาพมุมสูงของวิทยาลัยอาชีวศึกษานครศรีธรรมราชครับ'),
-    'certificate1': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Vocationalcertificateset1.jpg','การแต่งกายนักศึกษาปวช.'),
-    'certificate2': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Vocationalcertificateset2.jpg','การแต่งกายนักศึกษาปวส.'),
-    'Discipline': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Discipline.jpg','การแต่งกายของนักเรียนนักศึกษา'),
+# ข้อมูลวิทยาลัย (โหลดครั้งเดียวตอนเริ่มระบบ แล้วเก็บไว้ใน Context Cache ของ Gemini)
+PDF_CONTEXT_TEXT = read_txt_context("dataNVC.txt")
+# เวอร์ชันของข้อมูล (md5 ย่อ) ใช้เป็นส่วนหนึ่งของ Key ของ Cache คำตอบใน Supabase
+CONTEXT_VERSION = hashlib.md5(PDF_CONTEXT_TEXT.encode('utf-8')).hexdigest()[:8]
+CONTEXT_PROMPT = f"""
+    ### 📘 Context (ข้อมูลวิทยาลัย)
+    {PDF_CONTEXT_TEXT}
+    """
+
+# Template ส่วนที่เปลี่ยนทุกข้อความ (ประวัติ + คำถาม) สร้างครั้งเดียว ส่วนข้อมูลวิทยาลัยอยู่ใน Context Cache แล้ว
+PROMPT_TURN_TEMPLATE = (
+    "### 💬 History (ประวัติการคุย)\n{history}\n\n"
+    "### ❓ Question (คำถามล่าสุด)\n{question}\n\n"
+    "### Answer\n"
+)
+# กรณีใช้ Retrieval: แนบเฉพาะข้อมูลวิทยาลัยส่วนที่เกี่ยวข้องไว้หน้าประวัติการคุย
+RETRIEVED_CONTEXT_TEMPLATE = "### 📘 Context (ข้อมูลวิทยาลัยที่เกี่ยวข้อง)\n{context}\n\n"
+
+# ตัวจัดการ Key และตัวเลือกข้อมูลวิทยาลัย (สร้างใน init_services())
+key_manager: GeminiKeyManager | None = None
+context_retriever = ContextRetriever(PDF_CONTEXT_TEXT)
+
+def _init_gemini():
+    global key_manager
+    # เริ่มจากยังไม่มีข้อมูลวิทยาลัย -> ถ้าไม่ได้ใช้ Retrieval ค่อยใส่ข้อมูลทั้งไฟล์ลง Context Cache
+    key_manager = GeminiKeyManager(SYSTEM_INSTRUCTION, None)
+    if not key_manager.keys: return
+    if not context_retriever.build():
+        key_manager.set_context_prompt(CONTEXT_PROMPT)
+    # ไม่มี Context Cache (โหมด Retrieval หรือสร้าง Cache ไม่ได้): ไม่ต้องต่ออายุ และไม่เรียก genai.configure จาก Thread อื่น
+    if key_manager.context_cached:
+        threading.Thread(target=_context_cache_refresh_loop, daemon=True).start()
+
+_services_ready = False
+
+def init_services():
+    """
+    เชื่อมต่อบริการภายนอก (Gemini, Supabase, Redis, โมเดล Embedding) ครั้งเดียวตอนเริ่ม Server
+    ไม่ทำตอน import: import app ได้โดยไม่ต้องมีกุญแจลับ และบริการที่ใช้ไม่ได้จะถูกปิดแทนการหยุดโปรแกรม
+    """
+    global _services_ready
+    if _services_ready: return
+    _init_supabase()
+    _init_redis()
+    semantic_cache.load()
+    _init_gemini()
+    _services_ready = True
+
+# --- คำถามที่พบบ่อย (FAQ): ตอบทันทีโดยไม่ต้องถาม Gemini ---
+# (คีย์เวิร์ด, คำตอบสำเร็จรูป) อ้างอิงข้อมูลจาก dataNVC.txt ถ้าข้อมูลในไฟล์เปลี่ยน ต้องแก้ที่นี่ด้วย
+FAQ_MAX_MESSAGE_LENGTH = 30 # ใช้ FAQ เฉพาะข้อความสั้นๆ (คำถามยาวให้ Gemini ตอบ)
+FAQ_MIN_COVERAGE = 0.4 # คีย์เวิร์ดต้องยาวอย่างน้อย 40% ของข้อความ (กันคำทักทายในประโยคยาว)
+ADDRESS_REPLY = "วิทยาลัยอาชีวศึกษานครศรีธรรมราช ตั้งอยู่เลขที่ 1076 ถนนราชดำเนิน ตำบลคลัง อำเภอเมือง จังหวัดนครศรีธรรมราช 80000 ครับ\n\n📍 แผนที่: https://maps.app.goo.gl/6FNi77eSuXU6iYmd7"
+CONTACT_REPLY = "☎️ ติดต่อวิทยาลัยอาชีวศึกษานครศรีธรรมราชได้ที่\n* โทรศัพท์ 0-7535-6156\n* โทรสาร 0-7534-2371\n* E-mail: nakhonsi@nvc.ac.th\n* เว็บไซต์: http://www.nvc.ac.th"
+FAQ_ENTRIES = [
+    (("สวัสดี", "หวัดดี", "hello"),
+     "สวัสดีครับ! 😊 พี่คือบอทผู้ช่วยของวิทยาลัยอาชีวศึกษานครศรีธรรมราช อยากสอบถามเรื่องไหน พิมพ์มาได้เลยครับ"),
+    (("ขอบคุณ", "ขอบใจ", "thank"),
+     "ยินดีครับ! 🙏 ถ้ามีคำถามเพิ่มเติม ถามพี่ได้ตลอดเลยครับ"),
+    (("ที่อยู่", "ตั้งอยู่ที่ไหน"), ADDRESS_REPLY),
+    (("เบอร์โทร", "เบอร์ติดต่อ", "โทรศัพท์", "ติดต่อวิทยาลัย"), CONTACT_REPLY),
+    (("อีเมล", "อีเมล์", "email", "e-mail"),
+     "📧 E-mail ของวิทยาลัยคือ nakhonsi@nvc.ac.th ครับ"),
+    (("เว็บไซต์", "เว็บวิทยาลัย", "website"),
+     "🌐 เว็บไซต์ของวิทยาลัยคือ http://www.nvc.ac.th ครับ"),
+    (("ห้องสมุด",),
+     "📚 ห้องสมุด (งานวิทยบริการ) อยู่ที่อาคาร 1 ชั้น 2 เปิดให้บริการ 08:00 - 17:00 น. มีบริการยืม-คืนหนังสือ และบริการคอมพิวเตอร์สำหรับนักศึกษาครับ"),
+    (("โรงอาหาร",),
+     "🍛 โรงอาหารหลักอยู่บริเวณอาคาร 4 และ 5 ครับ"),
+    (("หอพัก",),
+     "ทางวิทยาลัยไม่มีหอพักภายในครับ แต่รอบๆ วิทยาลัย (ย่านท่าวัง) มีหอพักเอกชนและอพาร์ตเมนต์ให้เช่าเยอะมาก ราคาไม่แพงและเดินทางสะดวกครับ"),
+    (("กยศ", "กู้เงินเรียน"),
+     "กู้ กยศ. ได้แน่นอนครับ! ทางวิทยาลัยมีงานกองทุนให้คำปรึกษา ทั้งผู้กู้รายเก่าและรายใหม่ สามารถทำเรื่องกู้ได้ตั้งแต่ช่วงมอบตัวครับ"),
+    (("ทวิภาคีคืออะไร", "ทวิภาคี คืออะไร"),
+     "ระบบทวิภาคี คือการ 'เรียนไปทำงานไป' ครับ น้องจะได้เรียนในวิทยาลัยส่วนหนึ่ง และไปฝึกงานจริงในสถานประกอบการอีกส่วนหนึ่ง ได้ทั้งเบี้ยเลี้ยงและประสบการณ์ทำงานจริงครับ"),
+    (("กศน", "เด็กซิ่ว"),
+     "รับครับ! ผู้ที่จบ กศน. หรือเทียบเท่า สามารถสมัครเข้าเรียนต่อได้ ทั้งในระดับ ปวช. และ ปวส. โดยเตรียมวุฒิการศึกษาตัวจริงมายื่นในวันสมัครได้เลยครับ"),
+    (("ใส่ชุดอะไรไปสมัคร", "แต่งตัวไปสมัคร"),
+     "แนะนำให้ใส่ชุดนักเรียน/นักศึกษาของสถาบันเดิมให้เรียบร้อยครับ เพื่อความสะดวกในการถ่ายรูปทำบัตรและการติดต่อราชการครับ"),
+    (("เกรดเท่าไหร่", "เกรดไม่ถึง", "ใช้เกรด"),
+     "ปกติทางวิทยาลัยฯ รับผู้ที่มีเกรดเฉลี่ยสะสม (GPA) 2.00 ขึ้นไปครับ แต่ถ้าเกรดไม่ถึง แนะนำให้ลองเข้ามาสอบถามที่งานทะเบียน หรือรอสมัครรอบสอบคัดเลือกทั่วไป อาจมีโอกาสในบางสาขาวิชาครับ"),
+    (("สีประจำวิทยาลัย",),
+     "สีประจำวิทยาลัยคือ \"แดง – ดำ\" ครับ ❤️🖤"),
+    (("ดอกไม้ประจำวิทยาลัย",),
+     "ดอกไม้ประจำวิทยาลัยคือ \"ดอกลีลาวดี\" ครับ 🌸"),
+    (("ปรัชญาวิทยาลัย", "ปรัชญาของวิทยาลัย"),
+     "ปรัชญาของวิทยาลัยคือ \"ทักษะนำ คุณธรรมเด่น เน้นคุณภาพ\" ครับ"),
+    (("ผู้อำนวยการ", "ผอ."),
+     "ผู้อำนวยการวิทยาลัยอาชีวศึกษานครศรีธรรมราช คือ นายสายันต์ แสงสุริยันต์ ครับ"),
+    (("เข้าแถวกี่โมง", "เรียนกี่โมง", "เวลาเรียน"),
+     "วิทยาลัยมีการเรียน 2 ภาคครับ\n* ภาคเช้า: เข้าแถว 07:30 น. เริ่มเรียน 08:00 น.\n* ภาคบ่าย: เริ่มเรียน 10:00 น. เข้าแถว 17:00 น."),
+]
+# วลีที่มีคีย์เวิร์ด FAQ อยู่ข้างใน แต่ความหมายต่างกัน (เช่น "รองผู้อำนวยการ" ไม่ใช่ "ผู้อำนวยการ", "ใช้โทรศัพท์" ไม่ได้ขอเบอร์)
+# ค้นหาแบบเลือกคำที่ยาวที่สุด/อยู่ซ้ายสุด วลีเหล่านี้จึงชนะคีย์เวิร์ดที่ซ้อนอยู่ข้างใน แล้วให้ Gemini ตอบแทน
+FAQ_BLOCKERS = (
+    "รองผู้อำนวยการ", "รอง ผู้อำนวยการ", "ผู้ช่วยผู้อำนวยการ", "ผู้อำนวยการฝ่าย", "ผู้อำนวยการกอง",
+    "รองผอ.", "รอง ผอ.", "ผอ.ฝ่าย",
+    "ใช้โทรศัพท์", "เล่นโทรศัพท์", "พกโทรศัพท์", "โทรศัพท์มือถือ",
+)
+faq_matcher = KeywordMatcher({
+    **{kw: answer for keywords, answer in FAQ_ENTRIES for kw in keywords},
+    **{phrase: None for phrase in FAQ_BLOCKERS},
+})
+
+# --- คำตอบสำเร็จรูปของปุ่มเมนูลัด: (ข้อความ, แท็กรูปภาพ หรือ None) ---
+# ปุ่มที่ไม่มีในนี้ (เช่น แผนกวิชาทั้งหมด) ต้องใช้ข้อมูลวิทยาลัย จึงให้ Gemini ตอบ (แล้วเก็บลง Cache) ตามปกติ
+BUTTON_REPLIES = {
+    "📍 แผนที่วิทยาลัย": (ADDRESS_REPLY, 'map'),
+    "☎️ ติดต่อเรา": (CONTACT_REPLY, None),
+    "🔒 กฎระเบียบวินัย": ("🔒 ระเบียบการแต่งกายและวินัยของนักเรียนนักศึกษา ตามภาพเลยครับ ถ้าสงสัยข้อไหน ถามพี่เพิ่มได้นะครับ", 'Discipline'),
+    "📝 การรับสมัครปริญญาตรี": ("📝 ประกาศรับสมัครนักศึกษาใหม่ ระดับปริญญาตรี ตามภาพเลยครับ ถ้าอยากรู้รายละเอียดสาขาหรือคุณสมบัติ พิมพ์ถามพี่ได้เลยครับ", 'QU'),
+    "🔍 สามารถสอบถามอะไรได้บ้าง": (
+        "พี่ตอบเรื่องต่างๆ ของวิทยาลัยได้ครับ เช่น\n"
+        "* 📖 แผนกวิชาและหลักสูตรที่เปิดสอน\n"
+        "* 📝 การรับสมัคร ปวช. / ปวส. / ปริญญาตรี\n"
+        "* 🏫 อาคาร ห้องเรียน และแผนที่วิทยาลัย\n"
+        "* 👩‍🏫 ครูและบุคลากรแต่ละแผนก\n"
+        "* 👕 การแต่งกายและระเบียบวินัย\n"
+        "พิมพ์คำถามมาได้เลยครับ!",
+        None
+    ),
 }
 
-# คำสั่งพิเศษ (Prompt) เพื่อสอนให้ Gemini รู้จักแท็กรูปภาพ
-IMAGE_PROMPT_INSTRUCTIONS = """
-    ### 🖼️ คำสั่งพิเศษเกี่ยวกับรูปภาพ
-    นอกจากการตอบคำถามแล้ว คุณสามารถแนะนำรูปภาพประกอบได้
-    หากคำถามของผู้ใช้หรือคำตอบของคุณเกี่ยวข้องกับรายการใดต่อไปนี้ ให้คุณ **เพิ่มแท็ก** พิเศษต่อท้ายคำตอบของคุณ:
+def match_faq(message: str) -> str | None:
+    """หาคำตอบสำเร็จรูปจาก FAQ (คืน None ถ้าไม่ตรง หรือคำถามซับซ้อนเกินกว่าจะตอบแบบสำเร็จรูป)"""
+    clean_message = message.strip().lower()
+    if not clean_message or len(clean_message) > FAQ_MAX_MESSAGE_LENGTH: return None
+
+    matches = faq_matcher.find_longest(clean_message)
+    answers = {answer for _, answer in matches}
+    # ถ้าเจอหลายหัวข้อในข้อความเดียว หรือเจอวลีที่ความหมายต่างจาก FAQ ให้ Gemini เป็นคนตอบ
+    if len(answers) != 1 or None in answers: return None
+    longest_keyword = max((kw for kw, _ in matches), key=len)
+    if len(longest_keyword) / len(clean_message) < FAQ_MIN_COVERAGE: return None
+    return answers.pop()
+
+# --- ตั้งค่าการทยอยแสดงคำตอบ (Streaming) ---
+STREAM_EDIT_INTERVAL = 0.8 # แก้ไขข้อความได้ไม่ถี่กว่านี้ (วินาที) กันชน Rate Limit ของ Telegram
+STREAM_EDIT_MIN_CHARS = 40 # ต้องมีข้อความใหม่อย่างน้อยกี่ตัวอักษรถึงจะแก้ไข
+
+# --- ตั้งค่าเวลารอ Gemini (Timeout) และการลองใหม่ (Retry) ---
+GEMINI_TIMEOUT_SECONDS = 15 # เวลาสูงสุดที่ยอมรอคำตอบจาก Gemini ต่อครั้ง (แบบ Streaming: รอข้อความส่วนแรก)
+GEMINI_STREAM_IDLE_SECONDS = 10 # Streaming: ถ้าไม่มีข้อความส่วนใหม่นานเกินนี้ ถือว่าค้าง
+GEMINI_STREAM_MAX_SECONDS = 120 # Streaming: เวลาสูงสุดของทั้งคำตอบ (กันคำขอค้างตลอดไป)
+GEMINI_RETRY_ATTEMPTS = 3 # จำนวนครั้งที่ลองใหม่เบื้องหลังเมื่อหมดเวลา
+GEMINI_RETRY_BASE_DELAY = 0.5 # เวลาพักก่อนลองใหม่ (0.5, 1, 2 วินาที)
+BUSY_MESSAGE = "ขออภัยครับ ระบบประมวลผลหนาแน่นมาก กรุณาลองใหม่อีกครั้งในภายหลังครับ"
+SLOW_MESSAGE = "ขออภัยครับ ตอนนี้ระบบตอบช้ากว่าปกติ พี่กำลังหาคำตอบให้อยู่ เดี๋ยวส่งตามไปให้นะครับ 🙏"
+
+# Regex ของแท็กรูปภาพ (Compile ครั้งเดียว) รวมช่องว่างรอบแท็กไว้ด้วย เพื่อลบออกได้ในครั้งเดียว
+# ชื่อแท็กมีขีดกลางได้ (เช่น [IMAGE:Birds-eye])
+_IMAGE_TAG_RE = re.compile(r'\s*\[IMAGE:([\w-]+)\]\s*')
+_PARTIAL_TAG_RE = re.compile(r'\[[\w:-]*$') # แท็กที่ยังส่งมาไม่ครบ (ระหว่าง Streaming)
+
+def strip_image_tags(text: str) -> str:
+    """ลบแท็กรูปภาพ (เช่น [IMAGE:map]) ออกจากข้อความที่จะแสดงให้ผู้ใช้"""
+    return _IMAGE_TAG_RE.sub('', text).strip()
+
+def extract_image_tag(response_text: str) -> tuple[str | None, str]:
+    """
+    ตรวจสอบแท็กรูปภาพจากคำตอบ (เช่น [IMAGE:map])
+    คืนค่า (แท็กที่จะส่งรูป หรือ None, ข้อความที่ลบแท็กออกแล้ว)
+    """
+    # ค้นหาแท็กทั้งหมด และลบออกจากข้อความไปพร้อมกันในการสแกนรอบเดียว
+    all_tags_found = []
+    def _collect(match):
+        all_tags_found.append(match.group(1))
+        return ''
+    cleaned_response = _IMAGE_TAG_RE.sub(_collect, response_text).strip()
+    if not all_tags_found:
+        return None, response_text
+
+    # กฎ: ถ้าเจอแท็ก "มากกว่า 1 อัน" แปลว่าเป็น List รายชื่อ -> ไม่ต้องส่งรูปสักรูป!
+    # กฎ: ถ้าเจอ "แค่ 1 อัน" -> ส่งรูปนั้น
+    image_tag = None
+    if len(all_tags_found) == 1:
+        image_tag = all_tags_found[0]
+        logger.info(f"Image Tag Detected: {image_tag}")
+    else:
+        logger.info(f"Multiple tags detected ({len(all_tags_found)} tags). Ignoring images to prevent spam.")
 
-    -   เกี่ยวกับ "📍 แผนที่วิทยาลัย", "ที่ตั้ง", หรือ "การเดินทาง" ไปยังวิทยาลัย: ให้เพิ่มแท็ก `[IMAGE:map]`
-    -   เกี่ยวกับ "ผัง" หรือ "ผังอาคาร": ให้เพิ่มแท็ก `[IMAGE:pang]`
-    -   เกี่ยวกับ "นักศึกษาใหม่ ระดับปริญญาตรี รอบโควตาทั่วไป ประจำปีการศึกษา 2569": ให้เพิ่มแท็ก `[IMAGE:QU]`
-    -   เกี่ยวกับ "นักศึกษาใหม่ ปวช. และ ปวส. รอบโควตาพิเศษ" หรือ เอกสารการรายงานตัว : ให้เพิ่มแท็ก `[IMAGE:quota_round_1]`
-    -   เกี่ยวกับ "📝 การรับสมัคร": ให้เพิ่มแท็ก `[IMAGE:quota_round_2]`
-    -   เกี่ยวกับ "ขั้นตอนการสมัครเข้าศึกษาต่อ ระบบออนไลน์ หรือ สมัครทางออนไลน์ : ให้เพิ่มแท็ก `[IMAGE:quota_round_3]`
-    -   เกี่ยวกับ "การผ่อนผันเข้ารับราชการทหาร ประจำปีการศึกษา 2569": ให้เพิ่มแท็ก `[IMAGE:pp]`
+    # 🧹 ทำความสะอาด: คืนข้อความที่ลบ "ทุกแท็ก" ออกแล้ว
+    return image_tag, cleaned_response
 
+TELEGRAM_CAPTION_LIMIT = 1024 # ความยาวสูงสุดของคำบรรยายรูป (Caption) ที่ Telegram รับได้
 
-    -   เกี่ยวกับ "ภาพมุมสูง": ให้เพิ่มแท็ก `[IMAGE:Birds-eye]`
-    -   เกี่ยวกับ "การแต่งกายปวช.": ให้เพิ่มแท็ก `[IMAGE:certificate1]`
-    -   เกี่ยวกับ "การแต่งกายปวส.": ให้เพิ่มแท็ก `[IMAGE:certificate2]`
-    -   เกี่ยวกับ "ระเบียบวินัยทั่วไป" หรือ "ระเบียบวินัย": ให้เพิ่มแท็ก `[IMAGE:Discipline]`
+async def send_image(context: ContextTypes.DEFAULT_TYPE, chat_id: int, image_tag: str | None, caption: str | None = None) -> bool:
+    """
+    ส่งรูปภาพตามแท็ก (รูปเดียว หรือ อัลบั้ม) คืนค่า True ถ้าส่งสำเร็จ
+    caption: คำบรรยายรูปแรก (ถ้าไม่ระบุ ใช้คำบรรยายจาก IMAGE_LOOKUP)
+    """
+    if not image_tag or image_tag not in IMAGE_LOOKUP: return False
+    image_data, default_caption = IMAGE_LOOKUP[image_tag]
+    urls = image_data if isinstance(image_data, list) else [image_data]
+    caption = caption or default_caption
+    try:
+        if len(urls) == 1: # รูปเดียว (Telegram ไม่รับอัลบั้มที่มีรูปเดียว)
+            await context.bot.send_photo(chat_id=chat_id, photo=urls[0], caption=caption)
+        else: # อัลบั้มหลายรูป: ใส่คำบรรยายไว้ที่รูปแรก
+            media = [InputMediaPhoto(urls[0], caption=caption)] + [InputMediaPhoto(url) for url in urls[1:]]
+            await context.bot.send_media_group(chat_id=chat_id, media=media)
+        return True
+    except Exception as e:
+        logger.error(f"Error sending image {image_tag}: {e}")
+        return False
 
+async def send_text_and_image(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, image_tag: str | None) -> bool:
+    """
+    ส่งคำตอบ + รูปภาพ (กรณีไม่ได้ Streaming)
+    ถ้าข้อความสั้นพอ จะใช้เป็นคำบรรยายรูปแล้วส่งรวมในคำขอเดียว ไม่งั้นส่งข้อความก่อนแล้วตามด้วยรูป
+    คืนค่า True ถ้าส่งรูปสำเร็จ
+    """
+    if text and image_tag in IMAGE_LOOKUP and len(text) <= TELEGRAM_CAPTION_LIMIT:
+        if await send_image(context, chat_id, image_tag, caption=text):
+            return True
+    if not text:
+        return await send_image(context, chat_id, image_tag)
+    # ส่งข้อความและรูปพร้อมกัน (ไม่ต้องรอทีละคำขอ) ถ้ารูปส่งไม่สำเร็จ ข้อความก็ยังถึงผู้ใช้
+    text_result, image_sent = await asyncio.gather(
+        context.bot.send_message(chat_id=chat_id, text=text),
+        send_image(context, chat_id, image_tag),
+        return_exceptions=True
+    )
+    if isinstance(text_result, Exception):
+        raise text_result
+    return image_sent is True
+
+async def save_answer(user_message: str, response_text: str, query_vec=None):
+    """บันทึกคำตอบจาก Gemini ลง Cache (Semantic + Supabase) เพื่อใช้ตอบครั้งหน้า"""
+    # เก็บลง Semantic Cache เพื่อตอบคำถามที่ถามต่างกันแต่ความหมายเดียวกัน
+    await semantic_cache.add_async(user_message, response_text, query_vec)
+    # บันทึก Cache เฉพาะคำตอบที่มีคุณภาพ (ยาวพอสมควร)
+    if len(strip_image_tags(response_text)) > 5:
+        # บันทึก *full* response (รวม tag) ลง cache เพื่อให้ครั้งหน้าแสดงรูปได้ด้วย
+        await run_db(save_to_cache, user_message, response_text)
+
+async def edit_reply_text(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, text: str) -> None:
+    """แก้ไขข้อความที่ส่งไปแล้ว (ข้าม Error กรณีข้อความเหมือนเดิม)"""
+    try:
+        await context.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """เวลาที่ Telegram ขอให้รอก่อนส่งคำขอใหม่ (รองรับทั้งแบบตัวเลขและ timedelta)"""
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+async def edit_final_reply(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, text: str) -> None:
+    """แก้ไขเป็นคำตอบสุดท้าย ถ้าโดน Rate Limit ให้รอตามที่ Telegram กำหนดแล้วลองอีกครั้ง (คำตอบสุดท้ายต้องถึงผู้ใช้)"""
+    try:
+        await edit_reply_text(context, chat_id, message_id, text)
+    except RetryAfter as e:
+        await asyncio.sleep(retry_after_seconds(e))
+        await edit_reply_text(context, chat_id, message_id, text)
 
+class GeminiStreamStalled(Exception):
+    """Gemini หยุดส่งข้อความกลางคัน (หลังจากส่งมาแล้วบางส่วน) เก็บข้อความที่ได้รับแล้วไว้ใน partial_text"""
 
-    -   เกี่ยวกับ "ครูแผนกเทคโนโลยีธุรกิจดิจิทัล",หรือ "บุคลากรแผนกวิชาเทคโนโลยีธุรกิจดิจิทัล": ให้เพิ่มแท็ก `[IMAGE:DBT]`
-    -   เกี่ยวกับ "ครูแผนกสามัญ",หรือ "บุคลากรแผนกวิชาสามัญ": ให้เพิ่มแท็ก `[IMAGE:DeoGl]`
-    -   เกี่ยวกับ "ครูแผนกอาหารและโภชนาการ",หรือ "บุคลากรแผนกวิชาอาหารและโภชนาการ": ให้เพิ่มแท็ก `[IMAGE:DeoF]`
-    -   เกี่ยวกับ "ครูแผนกวิชาคหกรรมศาสตร์",หรือ "บุคลากรแผนกวิชาคหกรรมศาสตร์": ให้เพิ่มแท็ก `[IMAGE:DeoHEc]`
-    -   เกี่ยวกับ "ครูแผนกวิชาเทคโนโลยีแฟชั่นและเครื่องแต่งกาย",หรือ "บุคลากรแผนกวิชาเทคโนโลยีแฟชั่นและเครื่องแต่งกาย": ให้เพิ่มแท็ก `[IMAGE:DeoFaAT]`
-    -   เกี่ยวกับ "ครูแผนกวิชาการบัญชี",หรือ "บุคลากรแผนกวิชาการบัญชี": ให้เพิ่มแท็ก `[IMAGE:Ac]`
-    -   เกี่ยวกับ "ครูแผนกกวิชาการตลาด",หรือ "บุคลากรแผนกวิชาการตลาด": ให้เพิ่มแท็ก `[IMAGE:MkD]`
-    -   เกี่ยวกับ "ครูแผนกวิชาการจัดการสำนักงานดิจิทัล",หรือ "บุคลากรแผนกวิชาการจัดการสำนักงานดิจิทัล": ให้เพิ่มแท็ก `[IMAGE:Desom]`
-    -   เกี่ยวกับ "ครูแผนกวิชาการจัดการธุรกิจ",หรือ "บุคลากรแผนกวิชาการจัดการธุรกิจ",หรือ "บุคลากรแผนกวิชาการจัดการโลจิสติกส์และซัพพลายเซน": ให้เพิ่มแท็ก `[IMAGE:DeoLaSCM]`
-    -   เกี่ยวกับ "ครูแผนกวิชาการโรงแรม",หรือ "บุคลากรแผนกวิชาการโรงแรม": ให้เพิ่มแท็ก `[IMAGE:HDe]`
-    -   เกี่ยวกับ "ครูแผนกวิชาการจัดการธุรกิจท่องเที่ยว",หรือ "บุคลากรแผนกวิชาการจัดการธุรกิจท่องเที่ยว": ให้เพิ่มแท็ก `[IMAGE:DeoTBM]`
-    -   เกี่ยวกับ "ครูแผนกวิชาภาษาต่างประเทศ",หรือ "บุคลากรแผนกวิชาภาษาต่างประเทศ": ให้เพิ่มแท็ก `[IMAGE:DeoTBMa]`
-    -   เกี่ยวกับ "ครูแผนกวิชาเทคโนโลยีสารสนเทศ",หรือ "บุคลากรแผนกวิชาเทคโนโลยีสารสนเทศ": ให้เพิ่มแท็ก `[IMAGE:ITD]`
-    -   เกี่ยวกับ "ครูแผนกวิชาอุตสาหกรรมโลจิสติกส์",หรือ "บุคลากรแผนกวิชาอุตสาหกรรมโลจิสติกส์": ให้เพิ่มแท็ก `[IMAGE:DeoLI]`
+    def __init__(self, partial_text: str):
+        super().__init__("Gemini stream stalled")
+        self.partial_text = partial_text
 
+async def stream_gemini_reply(model, contents: list, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int) -> str:
+    """
+    ถาม Gemini แบบ Streaming แล้วทยอยแก้ไขข้อความใน Telegram ตามคำตอบที่ได้รับ
+    ผู้ใช้จะเห็นคำตอบส่วนแรกทันที ไม่ต้องรอจน Gemini ตอบเสร็จทั้งหมด
+    คืนค่าคำตอบเต็ม (รวมแท็กรูปภาพ) เพื่อนำไปประมวลผลต่อ
+
+    จำกัดเวลาแค่ "ข้อความส่วนแรก" (GEMINI_TIMEOUT_SECONDS) และ "ช่วงเงียบระหว่างส่วน" (GEMINI_STREAM_IDLE_SECONDS)
+    คำตอบยาวที่ยังทยอยมาเรื่อยๆ จะไม่ถูกตัด
+    - ยังไม่ได้ข้อความเลยแล้วหมดเวลา: โยน asyncio.TimeoutError (ให้ผู้เรียกลองใหม่เบื้องหลัง)
+    - ได้ข้อความแล้วบางส่วนแล้วค้าง: โยน GeminiStreamStalled พร้อมข้อความที่ได้รับแล้ว
+    """
+    loop = asyncio.get_running_loop()
+    first_chunk_deadline = loop.time() + GEMINI_TIMEOUT_SECONDS
+    stream = await asyncio.wait_for(
+        model.generate_content_async(contents, stream=True, request_options={'timeout': GEMINI_STREAM_MAX_SECONDS}),
+        timeout=GEMINI_TIMEOUT_SECONDS
+    )
+    chunks = aiter(stream)
+    buffer = ""
+    last_edit, last_len = time.monotonic(), 0
+    edits_paused_until = 0.0 # โดน Rate Limit ของ Telegram: งดแก้ไขระหว่างทางจนถึงเวลานี้
+    while True:
+        # ยังไม่มีข้อความ: รอได้ถึงกำหนดของส่วนแรก / มีข้อความแล้ว: รอส่วนถัดไปได้ไม่เกินช่วงเงียบที่กำหนด
+        timeout = max(first_chunk_deadline - loop.time(), 0) if not buffer else GEMINI_STREAM_IDLE_SECONDS
+        try:
+            chunk = await asyncio.wait_for(anext(chunks), timeout=timeout)
+        except StopAsyncIteration:
+            break
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            if buffer.strip():
+                raise GeminiStreamStalled(buffer.strip())
+            raise
+        try:
+            buffer += chunk.text
+        except ValueError:
+            continue # Chunk ที่ไม่มีข้อความ (เช่น ถูกกรองด้วย Safety)
+
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL or now < edits_paused_until or len(buffer) < last_len + STREAM_EDIT_MIN_CHARS:
+            continue
+        # ซ่อนแท็กรูปภาพ (รวมถึงแท็กที่ยังส่งมาไม่ครบ เช่น "[IMAGE:ma")
+        visible_text = _PARTIAL_TAG_RE.sub('', strip_image_tags(buffer)).strip()
+        if visible_text:
+            # Error จาก Telegram ระหว่างทางไม่ใช่ Error ของ Gemini: ข้ามการแก้ไขครั้งนี้ไป แล้วรับคำตอบต่อ
+            try:
+                await edit_reply_text(context, chat_id, message_id, visible_text)
+            except RetryAfter as e:
+                edits_paused_until = time.monotonic() + retry_after_seconds(e)
+                logger.warning(f"Telegram rate limit while streaming. Pausing edits for {retry_after_seconds(e):.0f}s")
+            except TelegramError as e:
+                logger.warning(f"Error editing streamed reply (skipped): {e}")
+            last_edit, last_len = time.monotonic(), len(buffer)
+    return buffer.strip()
+
+async def retry_gemini_with_backoff(gemini_prompt: str, context: ContextTypes.DEFAULT_TYPE, chat_id: int,
+                                    user_message: str, username: str, query_vec=None) -> None:
+    """
+    Background Task: ถาม Gemini ใหม่หลังจากครั้งแรกหมดเวลา (พักแบบ Exponential Backoff ก่อนลองแต่ละครั้ง)
+    ถ้าได้คำตอบ จะส่งตามไปให้ผู้ใช้เป็นข้อความใหม่
+    """
+    for attempt in range(GEMINI_RETRY_ATTEMPTS):
+        await asyncio.sleep(GEMINI_RETRY_BASE_DELAY * 2 ** attempt)
+        try:
+            gemini_response = await asyncio.wait_for(
+                key_manager.get_model().generate_content_async(
+                    key_manager.build_contents(gemini_prompt),
+                    request_options={'timeout': GEMINI_TIMEOUT_SECONDS}
+                ),
+                timeout=GEMINI_TIMEOUT_SECONDS + 1
+            )
+            response_text = gemini_response.text.strip()
+        except ResourceExhausted:
+            failed_index = key_manager.current_index
+            logger.warning(f"⚠️ Key {failed_index + 1} Exhausted during retry! Switching key...")
+            await key_manager.rotate_key_async(failed_index)
+            continue
+        except Exception as e:
+            logger.warning(f"Gemini retry {attempt + 1}/{GEMINI_RETRY_ATTEMPTS} failed: {e!r}")
+            continue
+        if not response_text:
+            continue
 
+        try:
+            image_tag, cleaned_response = extract_image_tag(response_text)
+            image_tag = match_image_tag(user_message) or image_tag
+            final_log_response = cleaned_response
+            if await send_text_and_image(context, chat_id, cleaned_response, image_tag):
+                final_log_response += f"\n(Sent Image: {image_tag})"
+            await save_chat_history(chat_id, 'bot', final_log_response, username)
+            await save_answer(user_message, response_text, query_vec)
+            logger.info(f"✅ Gemini retry succeeded on attempt {attempt + 1}")
+        except Exception as e:
+            logger.error(f"Error delivering retried answer: {e}", exc_info=True)
+        return
 
-    -   เกี่ยวกับ "อาคาร 1": หรือ "อาคารอำนวยการ": ให้เพิ่มแท็ก `[IMAGE:building_1]`
-    -   เกี่ยวกับ "อาคาร 2": ให้เพิ่มแท็ก `[IMAGE:building_2]`
-    -   เกี่ยวกับ "อาคาร 3": ให้เพิ่มแท็ก `[IMAGE:building_3]`
-    -   เกี่ยวกับ "อาคาร 4": ให้เพิ่มแท็ก `[IMAGE:building_4]`
-    -   เกี่ยวกับ "อาคาร 5": ให้เพิ่มแท็ก `[IMAGE:building_5]`
-    -   เกี่ยวกับ "อาคาร 6": ให้เพิ่มแท็ก `[IMAGE:building_6]`
-    -   เกี่ยวกับ "อาคาร 7": ให้เพิ่มแท็ก `[IMAGE:building_7]`
-    -   เกี่ยวกับ "อาคาร 8": ให้เพิ่มแท็ก `[IMAGE:building_8]`
-    -   เกี่ยวกับ "ห้อง 632": ให้เพิ่มแท็ก `[IMAGE:building_6_632]`
-    """
+    logger.error(f"Gemini retry gave up after {GEMINI_RETRY_ATTEMPTS} attempts for chat {chat_id}")
 
 # --- ส่วนจัดการการตอบโต้ (Telegram Handlers) ---
 
+# ปุ่มเมนูลัดด้านล่างจอ (แต่ละแถวของคีย์บอร์ด)
+QUICK_BUTTONS = [
+    ["📖 แผนกวิชาทั้งหมด", "📚 หลักสูตรที่เปิดสอน"],
+    ["📝 การรับสมัครปวช./ปวส.", "📝 การรับสมัครปริญญาตรี"],
+    ["📕 รูปแบบการเรียน", "🔍 สามารถสอบถามอะไรได้บ้าง"],
+    ["📍 แผนที่วิทยาลัย", "☎️ ติดต่อเรา", "🔒 กฎระเบียบวินัย"],
+]
+QUICK_BUTTON_TEXTS = {text for row in QUICK_BUTTONS for text in row}
+HISTORY_MIN_MESSAGE_LENGTH = 6 # ข้อความสั้นกว่านี้ (เช่น คำทักทาย) ไม่ต้องดึงประวัติแชท
+
+def needs_history(message: str) -> bool:
+    """ข้อความจากปุ่มเมนูลัด หรือข้อความสั้นมาก ตอบได้โดยไม่ต้องใช้ประวัติการคุย"""
+    message = message.strip()
+    return message not in QUICK_BUTTON_TEXTS and len(message) >= HISTORY_MIN_MESSAGE_LENGTH
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     ทำงานเมื่อผู้ใช้กด /start
@@ -346,12 +1109,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     username = user.username if user.username else user.first_name 
 
     # สร้างปุ่มเมนูลัดด้านล่างจอ
-    keyboard = [
-        [KeyboardButton("📖 แผนกวิชาทั้งหมด"), KeyboardButton("📚 หลักสูตรที่เปิดสอน")], 
-        [KeyboardButton("📝 การรับสมัครปวช./ปวส."), KeyboardButton("📝 การรับสมัครปริญญาตรี")],
-        [KeyboardButton("📕 รูปแบบการเรียน"), KeyboardButton("🔍 สามารถสอบถามอะไรได้บ้าง")],
-        [KeyboardButton("📍 แผนที่วิทยาลัย"),KeyboardButton("☎️ ติดต่อเรา"),KeyboardButton("🔒 กฎระเบียบวินัย")] 
-    ]
+    keyboard = [[KeyboardButton(text) for text in row] for row in QUICK_BUTTONS]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
     response_text = f"สวัสดีครับคุณ {user_name}! ผมคือบอทผู้ช่วยให้ข้อมูลการศึกษาต่อและข้อมูลทั่วไปวิทยาลัยอาชีวศึกษานครศรีธรรมราชครับ ยินดีให้บริการครับ"
@@ -360,8 +1118,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         # ส่งข้อความพร้อมปุ่ม
         await context.bot.send_message(chat_id=chat_id, text=response_text, reply_markup=reply_markup)
         # บันทึกประวัติว่าเริ่มใช้งาน
-        save_chat_history(chat_id, 'user', '/start', username)
-        save_chat_history(chat_id, 'bot', response_text, username)
+        await save_chat_turn(chat_id, [('user', '/start'), ('bot', response_text)], username)
     except Exception as e:
         logger.error(f"Error in start_command: {e}")
 
@@ -380,112 +1137,126 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user = update.message.from_user
     username = user.username if user.username else user.first_name 
     
-    logger.info(f"Message from {username} ({chat_id}): {user_message}")
+    # Log แค่ chat_id + ความยาวข้อความ (ไม่สร้าง f-string ทั้งข้อความในทุกคำขอ)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Message from chat {chat_id} (len={len(user_message)})")
 
     try:
-        # 1. เช็ค Cache ก่อน (เพื่อความเร็ว)
-        cached_answer = get_cached_response(user_message)
+        # 0. กดปุ่มเมนูลัดที่มีคำตอบสำเร็จรูป: ส่งข้อความ (+ รูป) ทันที
+        if user_message in BUTTON_REPLIES:
+            button_text, button_tag = BUTTON_REPLIES[user_message]
+            final_log_response = button_text
+            if await send_text_and_image(context, chat_id, button_text, button_tag):
+                final_log_response += f"\n(Sent Image: {button_tag})"
+            fire_and_forget(save_chat_turn(chat_id, [('user', user_message), ('bot', final_log_response)], username))
+            logger.info(f"✅ Used Button Reply. Processed in {time.time() - start_time:.4f}s")
+            return
+
+        # 0.1 คำถามสั้นๆ ที่ตรงกับ FAQ: ตอบทันทีโดยไม่ต้องถาม Gemini หรือเช็ค Cache
+        faq_answer = match_faq(user_message)
+        if faq_answer:
+            await context.bot.send_message(chat_id=chat_id, text=faq_answer)
+            fire_and_forget(save_chat_turn(chat_id, [('user', user_message), ('bot', faq_answer)], username))
+            logger.info(f"✅ Used FAQ. Processed in {time.time() - start_time:.4f}s")
+            return
+
+        # 0.2 ขอรูปอย่างเดียว (เช่น "แผนที่"): ส่งรูป + คำบรรยายที่เตรียมไว้ ไม่ต้องถาม Gemini
+        shortcut_tag = match_image_shortcut(user_message)
+        if shortcut_tag and await send_image(context, chat_id, shortcut_tag):
+            final_log_response = f"{IMAGE_LOOKUP[shortcut_tag][1]}\n(Sent Image: {shortcut_tag})"
+            fire_and_forget(save_chat_turn(chat_id, [('user', user_message), ('bot', final_log_response)], username))
+            logger.info(f"✅ Used Image Shortcut. Processed in {time.time() - start_time:.4f}s")
+            return
+
         response_text = ""
         is_cached = False
+        gemini_ok = False # ได้คำตอบจริงจาก Gemini (ไม่ใช่ข้อความแจ้งระบบหนาแน่น)
+        reply_message = None # ข้อความที่ส่งไปก่อนแล้วทยอยแก้ไข (กรณี Streaming)
+        query_vec = None
+
+        # 1. เช็ค Cache ในหน่วยความจำก่อน (เร็วที่สุด ไม่ต้องออก Network)
+        cached_answer = get_exact_cached(user_message)
+        chat_history_text = ""
+        if cached_answer:
+            logger.info("✅ Used LRU Cache")
+        else:
+            # 1.1 เช็ค Cache ใน Supabase พร้อมกับดึงประวัติแชท (ทำคู่กัน ไม่ต้องรอทีละอย่าง)
+            if needs_history(user_message):
+                cached_answer, chat_history_text = await asyncio.gather(
+                    run_db(get_cached_response, user_message),
+                    get_chat_history(chat_id, limit=8)
+                )
+            else:
+                cached_answer = await run_db(get_cached_response, user_message)
+            if cached_answer:
+                logger.info("✅ Used Cache")
 
         if cached_answer:
             response_text = cached_answer
             is_cached = True
-            logger.info("✅ Used Cache")
         else:
+            # 1.2 เช็ค Semantic Cache (คำถามที่ถามต่างกันแต่ความหมายใกล้เคียงกัน)
+            cached_answer, query_vec = await semantic_cache.lookup_async(user_message) # Embed ใน Thread แยก
+            if cached_answer:
+                response_text = cached_answer
+                is_cached = True
+                logger.info("✅ Used Semantic Cache")
+
+        if not is_cached:
             # 2. ถ้าไม่เจอใน Cache ให้ถาม Gemini
-            save_chat_history(chat_id, 'user', user_message, username) # บันทึกคำถาม
-            chat_history_text = get_chat_history(chat_id, limit=8) # ดึงประวัติเก่า
-            pdf_text = read_txt_context("dataNVC.txt") # โหลดข้อมูลวิทยาลัย (Lazy Load)
-
-            # สร้างคำสั่ง (Prompt) ส่งให้ Gemini
-            gemini_prompt = f"""
-            คุณคือแชทบอทผู้เชี่ยวชาญด้านข้อมูลของวิทยาลัยอาชีวศึกษานครศรีธรรมราช (NVC Assistant)
-            ***
-            ### 🎯 ภารกิจและบุคลิกภาพ (Persona)
-            1.  **น้ำเสียง (Tone):** สุภาพ, เป็นมิตร, ตอบเป็นธรรมชาติเหมือนรุ่นพี่แนะนำรุ่นน้อง, และกระตือรือร้น
-            2.  **ขอบเขต:** ตอบคำถามโดยยึดตาม **"ข้อมูลบริบทของวิทยาลัย"** ที่ให้มาเท่านั้น
-            3.  **ความลื่นไหล:** สรุปใจความให้กระชับ อ่านง่าย ข้อความไม่ยาวจนเกินไป
-
-            ### 🖼️ กฎเหล็กในการแสดงรูปภาพ (Strict Image Rules)
-            1.  **ความแม่นยำ:** ให้ใส่แท็กรูปภาพ **เฉพาะเมื่อ** ผู้ใช้ถามเจาะจงถึง "หัวข้อเดียว" หรือ "สถานที่เดียว" ที่มีในระบบเท่านั้น
-            2.  ❌ **ห้าม** ใส่แท็กรูปภาพในกรณีที่เป็นการ "แสดงรายชื่อ" (List), "สรุปภาพรวม", หรือ "บอกหัวข้อทั้งหมด" (เช่น ถามว่ามีแผนกอะไรบ้าง ห้ามใส่แท็กต่อท้ายรายชื่อแผนกมาเด็ดขาด)
-            3.  ถ้าผู้ใช้ไม่ได้ถามเจาะจง หรือเนื้อหาไม่ตรงกับแท็กที่มี อย่าเสนอรูปภาพมั่วซั่ว
-            **รายการแท็กที่รองรับอ้างอิงจาก: {IMAGE_PROMPT_INSTRUCTIONS}**
-
-            ### 📝 รูปแบบการจัดคำตอบ (Formatting)
-            1.  **Heading และ Bullet Points:** ใช้ตัวหนา (`**`) สำหรับหัวข้อ และใช้ `*` สำหรับรายการ เพื่อให้อ่านง่าย
-            2.  **เว้นวรรค:** เว้นบรรทัดระหว่างย่อหน้าเสมอ อย่าพิมพ์ติดกันเป็นพรืด
-
-            ### 🚨 การจัดการคำถามที่กว้างหรือกำกวม (Ambiguity Handling) - สำคัญมาก! ⭐️
-            หากคำถามของผู้ใช้ **กว้างมาก, ไม่เจาะจง** (เช่น "ขอข้อมูลวิทยาลัย", "มีแผนกอะไรบ้าง", "อยากเรียนต่อ"):
-            1.  ⛔️ **ห้าม** อธิบายรายละเอียดเนื้อหาทั้งหมดในทันที (เพื่อป้องกันข้อความยาวเกินไป)
-            2.  ✅ **ให้ตอบโดยการลิสต์ "หัวข้อ" หรือ "ทางเลือก"** สั้นๆ
-            3.  ✅ **ต้องจบประโยค** ด้วยการถามกลับเพื่อให้ผู้ใช้เลือกหัวข้อที่สนใจ
-
-            **ตัวอย่าง 1: เมื่อผู้ใช้ถามกว้างๆ เรื่องการสมัคร**
-            ผู้ใช้: "อยากสมัครเรียน"
-            บอท: "ยินดีต้อนรับครับ! 🎉 วิทยาลัยอาชีวศึกษานครศรีธรรมราช เปิดรับสมัครหลายรอบครับ เพื่อให้ข้อมูลที่ถูกต้อง รบกวนน้องระบุวุฒิปัจจุบันหน่อยครับ:
-            * จบ ม.3 -> เข้าต่อระดับ ปวช.
-            * จบ ม.6 / ปวช. -> เข้าต่อระดับ ปวส.
-            * จบ ปวส. -> เข้าต่อระดับ ปริญญาตรี
-            พิมพ์ระดับที่สนใจมาได้เลยครับ!"
-
-            **ตัวอย่าง 2: เมื่อผู้ใช้ไม่รู้จะเรียนอะไรดี**
-            ผู้ใช้: "เรียนสาขาอะไรดี" หรือ "แนะนำสาขาหน่อย"
-            บอท: "เพื่อให้น้องเลือกสาขาที่ใช่ที่สุด ลองบอกสิ่งที่ชอบหรือถนัดให้พี่รู้นิดนึงครับ เช่น:
-            * 💻 ชอบคอมพิวเตอร์/เทคโนโลยี
-            * 💰 ชอบตัวเลข
-            * 🍳 ชอบทำอาหาร
-            พิมพ์สิ่งที่ชอบมาสั้นๆ ได้เลยครับ เดี๋ยวพี่แนะนำสาขาที่เหมาะให้ครับ!"
-
-            ***
-
-            ### 🚨 ข้อจำกัดความปลอดภัย (Safety)
-            1.  ตอบ **เฉพาะข้อมูลที่มีในบริบท** เท่านั้น ห้ามแต่งเติมข้อมูลเองเด็ดขาด (No Hallucination)
-            2.  หากคำถามเกี่ยวข้องกับวิทยาลัย แต่ **ไม่มีข้อมูลในบริบท** ให้ตอบว่า "ขออภัยครับ ข้อมูลส่วนนี้พี่อาจจะยังไม่มี แนะนำให้ติดต่อสอบถามทางวิทยาลัยโดยตรง"
-            3.  หากคำถาม **ไม่เกี่ยวข้อง** กับวิทยาลัยเลย ให้แจ้งอย่างสุภาพว่าไม่สามารถตอบได้
-
-            ***
-            ### 📘 Context (ข้อมูลวิทยาลัย)
-            {pdf_text}
-
-            ### 💬 History (ประวัติการคุย)
-            {chat_history_text}
-
-            ### ❓ Question (คำถามล่าสุด)
-            {user_message}
-
-            ***
-            {IMAGE_PROMPT_INSTRUCTIONS}
-
-            ### Answer
-            """
+            # สร้างคำสั่ง (Prompt) ส่งให้ Gemini: เติมแค่ส่วนที่เปลี่ยนทุกครั้งลงใน Template ที่เตรียมไว้
+            gemini_prompt = PROMPT_TURN_TEMPLATE.format(history=chat_history_text, question=user_message)
+            if context_retriever.enabled:
+                # ข้อมูลวิทยาลัยใหญ่เกินจะส่งทั้งไฟล์: แนบเฉพาะส่วนที่เกี่ยวข้องกับคำถาม
+                retrieved_context = await context_retriever.retrieve(user_message)
+                gemini_prompt = RETRIEVED_CONTEXT_TEMPLATE.format(context=retrieved_context) + gemini_prompt
             
+            # ส่งข้อความชั่วคราวไปก่อน แล้วค่อยแก้ไขเป็นคำตอบจริงระหว่างที่ Gemini ทยอยตอบ
+            reply_message = await context.bot.send_message(chat_id=chat_id, text="…")
+
             # ส่งไปถาม Gemini
             max_retries = len(key_manager.keys) # ลองให้ครบทุกคีย์ที่มี (หรือกำหนดเลขเองเช่น 3)
             
             for attempt in range(max_retries):
                 try:
                     # 1. ดึง Model ปัจจุบันจาก Key Manager
+                    key_index = key_manager.current_index
                     current_model = key_manager.get_model()
                     
-                    # 2. เรียกใช้งาน
-                    gemini_response = current_model.generate_content(gemini_prompt)
+                    # 2. เรียกใช้งานแบบ Streaming (แบบ Async: ระหว่างรอ Gemini บอทยังรับข้อความของคนอื่นได้)
+                    # จำกัดเวลารอข้อความส่วนแรก และช่วงเงียบระหว่างส่วน (ไม่ตัดคำตอบยาวที่ยังทยอยมา)
+                    response_text = await stream_gemini_reply(
+                        current_model, key_manager.build_contents(gemini_prompt),
+                        context, chat_id, reply_message.message_id
+                    )
                     
-                    if gemini_response and gemini_response.text:
-                        response_text = gemini_response.text.strip()
+                    if response_text:
+                        gemini_ok = True
                         break #ถ้าสำเร็จ ให้หยุด Loop ทันที (ออกจาก for)
                         
                 except ResourceExhausted:
                     # ⚠️ ถ้า Key เต็ม (Error 429)
-                    logger.warning(f"⚠️ Key {key_manager.current_index + 1} Exhausted! Switching key...")
-                    key_manager.rotate_key() # สลับไปใช้ Key ถัดไป
+                    logger.warning(f"⚠️ Key {key_index + 1} Exhausted! Switching key...")
+                    await key_manager.rotate_key_async(key_index) # สลับไปใช้ Key ถัดไป (ใน Thread แยก)
                     
                     # ⭐️ (UPDATED) เพิ่มเวลาพักนานขึ้น
-                    time.sleep(1) # ถ้า Key 1-2 หมด ให้พัก 1 วินาที
+                    await asyncio.sleep(1) # ถ้า Key 1-2 หมด ให้พัก 1 วินาที (ไม่บล็อก Event Loop)
                         
                     continue 
+
+                except GeminiStreamStalled as e:
+                    # ⏸️ Gemini ส่งคำตอบมาแล้วบางส่วนแต่หยุดกลางคัน: เก็บข้อความที่ผู้ใช้เห็นแล้วไว้ ไม่ต้องถามใหม่
+                    # (ไม่บันทึกลง Cache เพราะคำตอบอาจไม่ครบ)
+                    logger.warning(f"⏸️ Gemini stream stalled after {len(e.partial_text)} chars. Keeping partial answer.")
+                    response_text = e.partial_text
+                    break
+
+                except (asyncio.TimeoutError, DeadlineExceeded):
+                    # ⏱️ Gemini ไม่ส่งข้อความส่วนแรกมาภายในเวลาที่กำหนด: แจ้งผู้ใช้ก่อน แล้วลองใหม่เบื้องหลัง (ส่งคำตอบตามไปทีหลัง)
+                    logger.warning(f"⏱️ Gemini sent nothing within {GEMINI_TIMEOUT_SECONDS}s. Retrying in background...")
+                    fire_and_forget(retry_gemini_with_backoff(gemini_prompt, context, chat_id, user_message, username, query_vec))
+                    response_text = SLOW_MESSAGE
+                    break
                     
                 except Exception as e:
                     # ถ้าเป็น Error อื่นๆ (เช่น 404, Network) ให้หยุดเลย ไม่ต้องวน
@@ -493,60 +1264,36 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     break
 
             if not response_text:
-                response_text = "ขออภัยครับ ระบบประมวลผลหนาแน่นมาก กรุณาลองใหม่อีกครั้งในภายหลังครับ"
-
-        # 3. ตรวจสอบแท็กรูปภาพจากคำตอบ (เช่น [IMAGE:map])
-        # ---------------------------------------------------------
-        # 3. (UPDATED) ระบบจัดการแท็กรูปภาพแบบอัจฉริยะ
-        # ---------------------------------------------------------
-        image_tag = None
-        cleaned_response = response_text
-        
-        # ค้นหาแท็กทั้งหมดที่มีในข้อความ
-        all_tags_found = re.findall(r'\[IMAGE:([\w_]+)\]', response_text)
-        
-        if all_tags_found:
-            # กฎ: ถ้าเจอแท็ก "มากกว่า 1 อัน" แปลว่าเป็น List รายชื่อ -> ไม่ต้องส่งรูปสักรูป!
-            # กฎ: ถ้าเจอ "แค่ 1 อัน" -> ส่งรูปนั้น
-            if len(all_tags_found) == 1:
-                image_tag = all_tags_found[0]
-                logger.info(f"Image Tag Detected: {image_tag}")
-            else:
-                logger.info(f"Multiple tags detected ({len(all_tags_found)} tags). Ignoring images to prevent spam.")
-                image_tag = None # บังคับไม่ให้ส่งรูป
-
-            # 🧹 ทำความสะอาด: ลบ "ทุกแท็ก" ออกจากข้อความที่จะส่งให้ผู้ใช้
-            # ใช้ re.sub เพื่อแทนที่ทุก pattern ด้วยค่าว่าง
-            cleaned_response = re.sub(r'\s*\[IMAGE:[\w_]+\]\s*', '', response_text).strip()
-
+                response_text = BUSY_MESSAGE
 
+        # 3. เลือกรูปภาพจากคีย์เวิร์ดในคำถาม (เฉพาะเมื่อได้คำตอบจริง)
+        #    ส่วนแท็กในคำตอบ (เช่น [IMAGE:map]) มีได้เฉพาะคำตอบเก่าใน Cache: ใช้เป็นตัวสำรอง และลบออกจากข้อความ
+        image_tag, cleaned_response = extract_image_tag(response_text)
+        if gemini_ok or is_cached:
+            image_tag = match_image_tag(user_message) or image_tag
 
-        # 4. ส่งคำตอบที่เป็นข้อความกลับไป
-        if cleaned_response:
-            await context.bot.send_message(chat_id=chat_id, text=cleaned_response)
-
-        # 5. ส่งรูปภาพตามไป (ถ้ามีแท็ก)
+        # 4-5. ส่งคำตอบและรูปภาพ
         final_log_response = cleaned_response
-        if image_tag and image_tag in IMAGE_LOOKUP:
-            image_data, caption = IMAGE_LOOKUP[image_tag]
-            try:
-                if isinstance(image_data, list): # กรณีเป็นอัลบั้มหลายรูป
-                    media = [InputMediaPhoto(url, caption=caption if i==0 else "") for i, url in enumerate(image_data)]
-                    await context.bot.send_media_group(chat_id=chat_id, media=media)
-                else: # กรณีเป็นรูปเดียว
-                    await context.bot.send_photo(chat_id=chat_id, photo=image_data, caption=caption)
-                
-                final_log_response += f"\n(Sent Image: {image_tag})" # บันทึกลง Log ว่าส่งรูปแล้ว
-            except Exception as e:
-                logger.error(f"Error sending image {image_tag}: {e}")
-
-        # 6. บันทึกประวัติและ Cache (เฉพาะกรณีไม่ได้ดึงมาจาก Cache)
-        if not is_cached:
-            save_chat_history(chat_id, 'bot', final_log_response, username)
-            # บันทึก Cache เฉพาะคำตอบที่มีคุณภาพ (ยาวพอสมควร)
-            if cleaned_response and len(cleaned_response) > 5:
-                # บันทึก *full* response (รวม tag) ลง cache เพื่อให้ครั้งหน้าแสดงรูปได้ด้วย
-                save_to_cache(user_message, response_text)
+        if reply_message:
+            # Streaming: ข้อความถูกส่งไปแล้ว แก้ไขเป็นคำตอบสุดท้าย พร้อมกับส่งรูปตามไป
+            if cleaned_response:
+                finalize = edit_final_reply(context, chat_id, reply_message.message_id, cleaned_response)
+            else:
+                finalize = context.bot.delete_message(chat_id=chat_id, message_id=reply_message.message_id)
+            _, image_sent = await asyncio.gather(finalize, send_image(context, chat_id, image_tag))
+        else:
+            # ตอบจาก Cache: ส่งข้อความพร้อมรูปในคำขอเดียว (ถ้าทำได้)
+            image_sent = await send_text_and_image(context, chat_id, cleaned_response, image_tag)
+        if image_sent:
+            final_log_response += f"\n(Sent Image: {image_tag})" # บันทึกลง Log ว่าส่งรูปแล้ว
+
+        # 6. บันทึกประวัติ และ Cache (Cache เฉพาะคำตอบใหม่จาก Gemini)
+        # ทำเบื้องหลัง ผู้ใช้ได้รับคำตอบไปแล้ว ไม่ต้องรอการเขียนข้อมูล
+        # บันทึกคำถาม + คำตอบของรอบนี้พร้อมกันในครั้งเดียว (รวมถึงกรณีตอบจาก Cache เพื่อให้ประวัติครบ)
+        fire_and_forget(save_chat_turn(chat_id, [('user', user_message), ('bot', final_log_response)], username))
+        if gemini_ok:
+            # ข้อความแจ้งระบบหนาแน่น/ตอบช้า ห้ามบันทึกลง Cache
+            fire_and_forget(save_answer(user_message, response_text, query_vec))
 
         logger.info(f"Processed in {time.time() - start_time:.4f}s")
 
@@ -556,11 +1303,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # --- ตั้งค่า Application ของ Telegram ---
 # เพิ่ม Timeout เพื่อป้องกัน Error เวลาเน็ตช้า
+# และใช้ HTTP Client ตัวเดียวตลอดอายุโปรแกรม: HTTP/2 + Connection Pool (ใช้ Connection เดิมซ้ำ ไม่ต้องเปิดใหม่ทุกครั้ง)
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "50")) # จำนวน Connection สูงสุดไปยัง api.telegram.org
+telegram_request = HTTPXRequest(
+    connection_pool_size=TELEGRAM_POOL_SIZE,
+    connect_timeout=5, # ต่อ Telegram ไม่ได้ใน 5 วินาที ให้ Error ทันที ไม่ค้างรอ
+    pool_timeout=5, # เวลารอ Connection ว่างใน Pool ตอนส่งข้อความพร้อมกันเยอะๆ
+    read_timeout=30,
+    write_timeout=30,
+    http_version='2',
+)
 application = (
     Application.builder()
     .token(BOT_TOKEN)
-    .read_timeout(30)
-    .write_timeout(30)
+    .request(telegram_request)
     .build()
 )
 
@@ -568,17 +1324,42 @@ application = (
 application.add_handler(CommandHandler("start", start_command))
 application.add_handler(MessageHandler(TEXT_FILTER, handle_message))
 
+# --- เริ่ม/ปิด Application ครั้งเดียวตลอดอายุของ Server (ไม่ต้อง initialize ทุก Request) ---
+@app.before_serving
+async def startup_application():
+    init_services()
+    await application.initialize()
+    app.chat_log_flusher = asyncio.create_task(flush_chat_log_loop())
+
+@app.after_serving
+async def shutdown_application():
+    """ปิด Application (และ Connection ไปยัง Telegram) ให้เรียบร้อยตอนปิดโปรแกรม"""
+    app.chat_log_flusher.cancel()
+    try:
+        await app.chat_log_flusher
+    except asyncio.CancelledError:
+        pass
+    # บันทึกประวัติแชทที่ยังค้างในคิวให้หมดก่อนปิด
+    await run_db(_insert_chat_history, _drain_chat_log_queue())
+    await application.shutdown()
+    supabase_http.close()
+
+async def process_update_in_background(update: Update) -> None:
+    """ประมวลผล Update จาก Telegram เบื้องหลัง (หลังจากตอบ 200 ให้ Telegram ไปแล้ว)"""
+    try:
+        await application.process_update(update)
+    except Exception as e:
+        logger.error(f"Error processing update {update.update_id}: {e}", exc_info=True)
+
 # --- Webhook Route (จุดรับข้อมูลจาก Telegram) ---
 @app.route(f'/{BOT_TOKEN}', methods=['POST'])
 async def webhook():
     if request.method == "POST":
         try:
-            # ต้องมีการ initialize และ shutdown สำหรับ v20+ ในโหมด Webhook
-            await application.initialize()
-            update = Update.de_json(request.get_json(force=True), application.bot)
-            await application.process_update(update)
-            await application.shutdown()
-            return jsonify({"status": "ok"})
+            update = Update.de_json(await request.get_json(force=True), application.bot)
+            # ตอบ Telegram ทันที (Ack) แล้วค่อยประมวลผลเบื้องหลัง ไม่ต้องรอ Gemini
+            fire_and_forget(process_update_in_background(update))
+            return jsonify({"status": "ok"}), 200
         except Exception as e:
             logger.error(f"Webhook error: {e}")
             return jsonify({"status": "error", "message": str(e)}), 400
@@ -590,5 +1371,6 @@ if __name__ == '__main__':
         # รันบนเครื่อง Local
         app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
     else:
-        # รันบน Render (Production) จะใช้ Gunicorn
+        # รันบน Render (Production) จะใช้ Uvicorn (ASGI) แบบ Worker เดียว รับงานพร้อมกันได้หลาย Request:
+        # uvicorn app:app --host 0.0.0.0 --port $PORT --workers 1 --loop uvloop --http httptools
         logger.info("Running in production mode.")
\ No newline at end of file
@@ -0,0 +1,244 @@
+import os
+import logging
+import time
+import asyncio
+import threading
+# Import เครื่องมือคำนวณเวกเตอร์
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Import โมเดล Embedding (ถ้าไม่ได้ติดตั้งไว้ ระบบ Semantic Cache จะถูกปิด)
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# Import ONNX Runtime + Tokenizer (ถ้ามีโมเดล int8 ที่ export ไว้ จะใช้แทน PyTorch เพราะเร็วกว่าหลายเท่า)
+try:
+    import onnxruntime as ort
+    from tokenizers import Tokenizer
+except ImportError:
+    ort = None
+    Tokenizer = None
+
+# Import HNSW (ค้นหาเวกเตอร์แบบประมาณ เร็วกว่าการเทียบทุกแถว เมื่อ Cache มีขนาดใหญ่)
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# --- ค่า Config ของ Semantic Cache (ปรับได้ผ่าน Environment Variables) ---
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.83")) # ความคล้ายขั้นต่ำ (Cosine)
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "86400")) # อายุคำตอบ (วินาที)
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+# โฟลเดอร์โมเดล ONNX int8 (สร้างด้วย `make embedding-model`) ต้องมี model.int8.onnx + tokenizer.json
+SEMANTIC_CACHE_ONNX_DIR = os.getenv("SEMANTIC_CACHE_ONNX_DIR", "onnx_model")
+# เริ่มใช้ HNSW เมื่อ Cache มีจำนวนรายการถึงค่านี้ (ถ้าน้อยกว่านี้ เทียบทุกแถวด้วย numpy เร็วพออยู่แล้ว)
+SEMANTIC_CACHE_HNSW_MIN_ENTRIES = int(os.getenv("SEMANTIC_CACHE_HNSW_MIN_ENTRIES", "2000"))
+HNSW_CANDIDATES = 8 # จำนวนคำถามใกล้เคียงที่ดึงมาตรวจ (เผื่อบางรายการหมดอายุ)
+ONNX_MAX_TOKENS = 128 # ตัดคำถามที่ยาวเกินนี้ (คำถามแชทส่วนใหญ่สั้นกว่านี้มาก)
+
+
+class OnnxEmbedder:
+    """
+    ตัวแปลงข้อความเป็นเวกเตอร์ด้วยโมเดล ONNX แบบ int8 (Mean Pooling เหมือน sentence-transformers)
+    มีเมธอดเหมือน SentenceTransformer (encode / get_sentence_embedding_dimension) จึงใช้แทนกันได้เลย
+    """
+
+    def __init__(self, model_dir: str):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = 1 # ใช้ 1 Thread ต่อการ Embed ไม่แย่ง CPU กับงานอื่นของบอท
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, "model.int8.onnx"),
+            sess_options=options,
+            providers=['CPUExecutionProvider']
+        )
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=ONNX_MAX_TOKENS)
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        # Embed ข้อความสั้นๆ หนึ่งครั้ง เพื่ออุ่นเครื่องและหาขนาดเวกเตอร์
+        self._dim = int(self.encode("warmup").shape[0])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(self, text: str, normalize_embeddings: bool = True):
+        encoding = self.tokenizer.encode(text)
+        input_ids = np.array([encoding.ids], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask], dtype=np.int64)
+        feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in self._input_names:
+            feeds['token_type_ids'] = np.zeros_like(input_ids)
+
+        token_vecs = self.session.run(None, feeds)[0] # (1, จำนวน Token, D)
+        mask = attention_mask[..., np.newaxis].astype(np.float32)
+        vec = (token_vecs * mask).sum(axis=1)[0] / max(float(mask.sum()), 1e-9)
+        if normalize_embeddings:
+            vec = vec / max(float(np.linalg.norm(vec)), 1e-12)
+        return vec.astype(np.float32)
+
+
+def load_embedding_model(model_name: str, onnx_dir: str = SEMANTIC_CACHE_ONNX_DIR):
+    """
+    โหลดโมเดล Embedding: ใช้ ONNX int8 ถ้ามีไฟล์และติดตั้ง onnxruntime ไว้ ไม่งั้นใช้ SentenceTransformer
+    คืนค่า None ถ้าใช้ไม่ได้ทั้งคู่
+    """
+    if ort is not None and os.path.isfile(os.path.join(onnx_dir, "model.int8.onnx")):
+        try:
+            model = OnnxEmbedder(onnx_dir)
+            logger.info(f"Semantic cache using ONNX int8 model from {onnx_dir}")
+            return model
+        except Exception as e:
+            logger.error(f"Error loading ONNX model: {e}. Falling back to sentence-transformers.")
+
+    if SentenceTransformer is None:
+        logger.warning("No ONNX model and sentence-transformers not installed. Semantic cache disabled. "
+                       "(pip install -r requirements.txt, or run `make embedding-model`)")
+        return None
+    return SentenceTransformer(model_name)
+
+
+class SemanticCache:
+    """
+    Cache คำตอบตาม "ความหมาย" ของคำถาม (ไม่ต้องพิมพ์ตรงกันทุกตัวอักษร)
+    เช่น "ค่าเทอมเท่าไหร่" กับ "ค่าเล่าเรียนกี่บาท" จะได้คำตอบเดียวกันโดยไม่ต้องถาม Gemini ใหม่
+
+    เก็บข้อมูลแบบวงแหวน (Ring Buffer) ขนาด max_entries: รายการที่ n (นับตั้งแต่เริ่ม) อยู่ที่ช่อง n % max_entries
+    และใช้ n เป็น label ใน HNSW ด้วย เมื่อเต็ม รายการใหม่จะเขียนทับช่องของรายการที่เก่าที่สุด
+    """
+
+    def __init__(self, model_name: str = SEMANTIC_CACHE_MODEL,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 ttl: int = SEMANTIC_CACHE_TTL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.model = None
+        self._lock = threading.Lock()
+
+        # ข้อมูลใน Cache: เวกเตอร์ (max_entries, D) จองไว้ครั้งเดียวตอนโหลดโมเดล (ไม่ต้องต่อ Array ใหม่ทุกครั้งที่เพิ่ม)
+        # + รายการคำถาม/คำตอบ/เวลาบันทึก ที่ใช้ช่องเดียวกัน
+        self.cache_vecs = np.empty((0, 0), dtype=np.float32)
+        self.cache_queries: list[str | None] = []
+        self.cache_answers: list[str | None] = []
+        self.cache_times: list[float] = []
+        self._next_id = 0 # จำนวนรายการที่เคยเพิ่มทั้งหมด (= label ของรายการถัดไป)
+        self.index = None
+
+    def load(self):
+        """โหลดโมเดล Embedding (เรียกครั้งเดียวตอนเริ่ม Server ถ้าโหลดไม่ได้ Semantic Cache จะถูกปิด)"""
+        if self.enabled: return
+        try:
+            model = load_embedding_model(self.model_name)
+            if model is None: return
+            self._init_storage(model.get_sentence_embedding_dimension())
+            self.model = model
+            logger.info(f"Semantic cache model loaded: {self.model_name} (dim={self.cache_vecs.shape[1]})")
+        except Exception as e:
+            logger.error(f"Error loading semantic cache model: {e}. Semantic cache disabled.")
+            self.model = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.model is not None
+
+    @property
+    def size(self) -> int:
+        """จำนวนรายการที่อยู่ใน Cache ตอนนี้ (รวมรายการที่หมดอายุแต่ยังไม่ถูกเขียนทับ)"""
+        return min(self._next_id, self.max_entries)
+
+    def _init_storage(self, dim: int):
+        """จองที่เก็บเวกเตอร์/ข้อความ และสร้าง HNSW Index (ถ้าติดตั้ง hnswlib ไว้) ขนาดเท่าจำนวนรายการสูงสุด"""
+        self.cache_vecs = np.zeros((self.max_entries, dim), dtype=np.float32)
+        self.cache_queries = [None] * self.max_entries
+        self.cache_answers = [None] * self.max_entries
+        self.cache_times = [0.0] * self.max_entries
+        self._next_id = 0
+        if hnswlib is None:
+            logger.info("hnswlib not installed. Semantic cache uses brute-force search.")
+            return
+        self.index = hnswlib.Index(space='cosine', dim=dim)
+        # allow_replace_deleted: ช่องของรายการที่ถูกลบ (เก่าสุด) จะถูกนำกลับมาใช้ใหม่ Index จึงไม่โตเกิน max_entries
+        self.index.init_index(max_elements=self.max_entries, ef_construction=100, M=16, allow_replace_deleted=True)
+        self.index.set_ef(50)
+
+    def _nearest(self, q):
+        """คืนรายการ (ช่อง, ความคล้าย) ที่ใกล้เคียงที่สุด เรียงจากคล้ายมาก -> น้อย (ต้องถือ Lock อยู่)"""
+        count = self.size
+        if self.index is not None and count >= SEMANTIC_CACHE_HNSW_MIN_ENTRIES:
+            labels, dists = self.index.knn_query(q, k=min(HNSW_CANDIDATES, count))
+            return [(int(label) % self.max_entries, 1.0 - float(dist)) for label, dist in zip(labels[0], dists[0])]
+
+        sims = self.cache_vecs[:count] @ q
+        order = np.argsort(-sims)[:HNSW_CANDIDATES]
+        return [(int(i), float(sims[i])) for i in order]
+
+    def encode(self, text: str):
+        """แปลงข้อความเป็นเวกเตอร์ (Normalize แล้ว เพื่อให้ dot product = cosine similarity)"""
+        if not self.enabled: return None
+        return self.model.encode(text.strip(), normalize_embeddings=True).astype(np.float32)
+
+    def lookup(self, query: str):
+        """
+        ค้นหาคำตอบที่ใกล้เคียงที่สุดใน Cache
+        คืนค่า (คำตอบ หรือ None, เวกเตอร์ของคำถาม) เพื่อนำเวกเตอร์ไปใช้ตอน add() ต่อได้โดยไม่ต้องคำนวณซ้ำ
+        """
+        if not self.enabled: return None, None
+        try:
+            q = self.encode(query)
+            with self._lock:
+                if self.size == 0:
+                    return None, q
+
+                now = time.time()
+                best_sim = -1.0
+                for row, sim in self._nearest(q):
+                    # ตัดคำตอบที่หมดอายุออกจากการพิจารณา
+                    if now - self.cache_times[row] > self.ttl: continue
+                    best_sim = max(best_sim, sim)
+                    if sim >= self.threshold:
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug(f"Semantic cache HIT ({sim:.3f}): '{query}' ~ '{self.cache_queries[row]}'")
+                        return self.cache_answers[row], q
+                    break # ผลลัพธ์เรียงจากคล้ายมากไปน้อย ถ้าอันแรกที่ยังไม่หมดอายุไม่ผ่าน อันถัดไปก็ไม่ผ่าน
+
+            # Log ข้อความของผู้ใช้เฉพาะระดับ DEBUG (ระดับ INFO ไม่ Log ทุกข้อความ)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Semantic cache MISS (best={best_sim:.3f}) for: {query}")
+            return None, q
+        except Exception as e:
+            logger.error(f"Error checking semantic cache: {e}")
+            return None, None
+
+    def add(self, query: str, answer: str, vec=None):
+        """บันทึกคำถาม/คำตอบใหม่ลง Cache (เมื่อเต็ม จะเขียนทับรายการที่เก่าที่สุด)"""
+        if not self.enabled: return
+        try:
+            if vec is None:
+                vec = self.encode(query)
+            with self._lock:
+                label = self._next_id
+                row = label % self.max_entries
+                if self.index is not None and label >= self.max_entries:
+                    # ลบรายการเก่าที่อยู่ในช่องนี้ออกจาก Index ก่อน เพื่อให้ช่องว่างพอสำหรับรายการใหม่
+                    self.index.mark_deleted(label - self.max_entries)
+                self.cache_vecs[row] = vec
+                self.cache_queries[row] = query.strip()
+                self.cache_answers[row] = answer
+                self.cache_times[row] = time.time()
+                if self.index is not None:
+                    self.index.add_items(vec[np.newaxis, :], [label], replace_deleted=True)
+                self._next_id += 1
+        except Exception as e:
+            logger.error(f"Error saving to semantic cache: {e}")
+
+    # Embedding เป็นงานของ CPU (หลายสิบมิลลิวินาที): เรียกจาก Event Loop ผ่าน Thread แยก ไม่ให้บอทค้าง
+    async def lookup_async(self, query: str):
+        return await asyncio.to_thread(self.lookup, query)
+
+    async def add_async(self, query: str, answer: str, vec=None):
+        await asyncio.to_thread(self.add, query, answer, vec)
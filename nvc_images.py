@@ -0,0 +1,106 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ไฟล์เก็บ file_id ของรูปที่อัปโหลดขึ้น Telegram แล้ว (สร้างด้วย `make image-ids`)
+# ถ้ามี file_id จะส่งรูปด้วย file_id แทน URL: Telegram ไม่ต้องดาวน์โหลดรูปจาก Supabase ใหม่ทุกครั้ง
+IMAGE_FILE_IDS_PATH = os.getenv("IMAGE_FILE_IDS_PATH", "image_file_ids.json")
+
+# คลังรูปภาพ: เชื่อมโยง 'แท็ก' (เช่น building_1) กับ 'URL รูปภาพ'
+IMAGE_SOURCES = {
+    'map': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/map.png', 'แผนที่วิทยาลัยอาชีวศึกษานครศรีธรรมราช'),
+    'pang': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/pang.png', 'ผังอาคารของวิทยาลัยอาชีวศึกษานครศรีธรรมราช'),
+    'pp': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/pp.jpg', 'การผ่อนผันทหาร'),
+    'QU': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/QU.jpg', 'ประกาศรับสมัคร ป.ตรี'),
+
+
+    'DBT': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DBT.png', 'บุคลากรแผนกวิชาเทคโนโลยีธุรกิจดิจิทัล'),
+    'DeoGl': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoGl.png', 'บุคลากรแผนกวิชาสามัญ'),
+    'DeoF': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoF.png', 'บุคลากรแผนกอาหารและโภชนาการ'),
+    'DeoHEc': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoHEc.png', 'บุคลากรแผนกวิชาคหกรรมศาสตร์'),
+    'DeoFaAT': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoFaAT.png', 'บุคลากรแผนกวิชาเทคโนโลยีแฟชั่นและเครื่องแต่งกาย'),
+    'Ac': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/Ac.png', 'บุคลากรแผนกวิชาการบัญชี'),
+    'MkD': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/MkD.png', 'บุคลากรแผนกวิชาการตลาด'),
+    'Desom': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/Desom.png', 'บุคลากรแผนกวิชาการจัดการสำนักงานดิจิทัล'),
+    'DeoLaSCM': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoLaSCM.png', 'บุคลากรแผนกวิชาการจัดการธุรกิจ/แผนกวิชาการจัดการโลจิสติกส์และซัพพลายเซน'),
+    'HDe': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/HDe.png', 'บุคลากรแผนกวิชาการโรงแรม'),
+    'DeoTBM': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoTBM.png', 'บุคลากรแผนกวิชาการจัดการธุรกิจท่องเที่ยว'),
+    'DeoTBMa': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoTBMa.png', 'บุคลากรแผนกวิชาภาษาต่างประเทศ'),
+    'ITD': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/ITD.png', 'บุคลากรแผนกวิชาเทคโนโลยีสารสนเทศ'),
+    'DeoLI': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/department/DeoLI.png', 'บุคลากรแผนกวิชาอุตสาหกรรมโลจิสติกส์'),
+
+    # ตัวอย่างการส่งหลายรูป (Album)
+    'quota_round_1': (
+        [
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Report.jpg',
+            
+        ], 
+        'เอกสารรายงานตัว'
+    ),
+    'quota_round_2': (
+        [
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/QOU1.jpg',
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/QU.jpg'
+        ], 
+        '📝 การรับสมัคร โควตากรณีพิเศษ (รอบที่ 1) ปีการศึกษา 2569'
+    ),
+    'quota_round_3': (
+        [
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply1.jpg',
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply2.jpg',
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply3.jpg',
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply4.jpg',
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply5.jpg',
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply6.jpg',
+            'https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Apply/Apply7.jpg',
+
+            
+        ], 
+        'ขั้นตอนการสมัครเข้าศึกษาต่อ ระบบออนไลน์'
+    ),
+
+
+    # ... (เพิ่มรายการอื่นๆ ที่นี่)
+    'building_1': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/1.png', 'นี่คือภาพอาคาร 1 ครับ'),
+    'building_2': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/2.png', 'นี่คือภาพอาคาร 2 ครับ'),
+    'building_3': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/3.png', 'นี่คือภาพอาคาร 3 ครับ'),
+    'building_4': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/4.png', 'นี่คือภาพอาคาร 4 ครับ'),
+    'building_5': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/5.png', 'นี่คือภาพอาคาร 5 ครับ'),
+    'building_6': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/6.png', 'นี่คือภาพอาคาร 6 ครับ'),
+    'building_7': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/7.png', 'นี่คือภาพอาคาร 7 ครับ'),
+    'building_8': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/8.png', 'นี่คือภาพอาคาร 8 ครับ'),
+    'building_6_632': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/IMG_20251117_132117.jpg', 'นี่คือห้อง 632 ครับ'),
+    # ...
+
+    'Birds-eye': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Birds-eyeview.png','นี่คือห้องภาพมุมสูงของวิทยาลัยอาชีวศึกษานครศรีธรรมราชครับ'),
+    'certificate1': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Vocationalcertificateset1.jpg','การแต่งกายนักศึกษาปวช.'),
+    'certificate2': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Vocationalcertificateset2.jpg','การแต่งกายนักศึกษาปวส.'),
+    'Discipline': ('https://squqrsinrzpqbvbnirzw.supabase.co/storage/v1/object/public/nvc_images/Discipline.jpg','การแต่งกายของนักเรียนนักศึกษา'),
+}
+
+
+def load_file_ids(path: str = IMAGE_FILE_IDS_PATH) -> dict[str, str]:
+    """โหลดตาราง URL -> file_id (ถ้าไม่มีไฟล์ คืนค่าว่าง แล้วส่งรูปด้วย URL ตามเดิม)"""
+    if not os.path.exists(path): return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading image file_ids: {e}. Sending images by URL.")
+        return {}
+
+
+def resolve_images(sources: dict, file_ids: dict[str, str]) -> dict:
+    """แทนที่ URL ที่อัปโหลดไว้แล้วด้วย file_id (URL ที่ยังไม่มี file_id ใช้ URL เดิม)"""
+    resolved = {}
+    for tag, (image_data, caption) in sources.items():
+        if isinstance(image_data, list):
+            resolved[tag] = ([file_ids.get(url, url) for url in image_data], caption)
+        else:
+            resolved[tag] = (file_ids.get(image_data, image_data), caption)
+    return resolved
+
+
+IMAGE_LOOKUP = resolve_images(IMAGE_SOURCES, load_file_ids())
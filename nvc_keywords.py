@@ -0,0 +1,75 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Import Aho-Corasick (ถ้าไม่ได้ติดตั้งไว้ จะใช้ Regex แบบรวมทุกคำแทน)
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+class KeywordMatcher:
+    """
+    ค้นหาคีย์เวิร์ดหลายคำในข้อความด้วยการสแกนรอบเดียว (Aho-Corasick)
+    สร้างครั้งเดียวตอนเริ่มระบบ แล้วใช้ค้นหาได้เร็วไม่ว่าจะมีคีย์เวิร์ดกี่คำ
+    คีย์เวิร์ดที่ลงท้ายด้วยตัวเลข จะไม่นับถ้าตัวถัดไปเป็นตัวเลขด้วย (เช่น "อาคาร 1" ไม่ตรงกับ "อาคาร 10")
+    """
+
+    def __init__(self, keywords: dict[str, object]):
+        # keywords: คีย์เวิร์ด -> ค่าที่ต้องการคืนเมื่อเจอคำนั้น (เช่น คำตอบ หรือ แท็กรูปภาพ)
+        self.keywords = {kw.lower(): value for kw, value in keywords.items()}
+        self._automaton = None
+        self._pattern = None
+
+        if not self.keywords:
+            return
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for kw, value in self.keywords.items():
+                self._automaton.add_word(kw, (kw, value))
+            self._automaton.make_automaton()
+        else:
+            logger.warning("pyahocorasick not installed. Falling back to regex keyword matching.")
+            # เรียงคำยาวก่อน เพื่อให้ Regex เลือกคำที่ยาวที่สุดเมื่อมีคำซ้อนกัน
+            ordered = sorted(self.keywords, key=len, reverse=True)
+            self._pattern = re.compile('|'.join(
+                re.escape(kw) + (r'(?!\d)' if kw[-1].isdigit() else '') for kw in ordered
+            ))
+
+    def _automaton_spans(self, text: str):
+        """(ตำแหน่งเริ่ม, ตำแหน่งจบ, คีย์เวิร์ด, ค่า) ทุกคำที่เจอ ยกเว้นคีย์เวิร์ดตัวเลขที่มีตัวเลขต่อท้าย"""
+        for end, (kw, value) in self._automaton.iter(text):
+            if kw[-1].isdigit() and end + 1 < len(text) and text[end + 1].isdigit():
+                continue
+            yield end - len(kw) + 1, end, kw, value
+
+    def find_all(self, text: str) -> list[tuple[str, object]]:
+        """คืนรายการ (คีย์เวิร์ด, ค่า) ทั้งหมดที่เจอในข้อความ เรียงตามตำแหน่งที่เจอ"""
+        text = text.lower()
+        if self._automaton is not None:
+            return [(kw, value) for _, _, kw, value in self._automaton_spans(text)]
+        if self._pattern is not None:
+            return [(m.group(0), self.keywords[m.group(0)]) for m in self._pattern.finditer(text)]
+        return []
+
+    def find_longest(self, text: str) -> list[tuple[str, object]]:
+        """
+        เหมือน find_all แต่ถ้าคีย์เวิร์ดซ้อนทับกัน จะเลือกคำที่ยาวที่สุดเท่านั้น
+        เช่น "แผนกการจัดการธุรกิจท่องเที่ยว" จะไม่นับ "แผนกการจัดการธุรกิจ" ซ้ำ
+        """
+        text = text.lower()
+        if self._automaton is None:
+            # Regex เรียงคำยาวก่อนและไม่ซ้อนทับกันอยู่แล้ว
+            return self.find_all(text)
+
+        # (ตำแหน่งเริ่ม, ตำแหน่งจบ, คีย์เวิร์ด, ค่า) เรียงจากซ้าย -> ขวา ถ้าเริ่มที่เดียวกันให้คำยาวมาก่อน
+        spans = sorted(self._automaton_spans(text), key=lambda span: (span[0], -len(span[2])))
+        matches = []
+        last_end = -1
+        for start, end, kw, value in spans:
+            if start <= last_end: continue # ทับกับคำที่เลือกไปแล้ว
+            matches.append((kw, value))
+            last_end = end
+        return matches
@@ -0,0 +1,95 @@
+import os
+import re
+import logging
+# Import เครื่องมือคำนวณเวกเตอร์
+import numpy as np
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+# --- ค่า Config ของการดึงข้อมูลเฉพาะส่วนที่เกี่ยวข้อง (Retrieval) ---
+# on = ใช้เสมอ, off = ส่งข้อมูลทั้งไฟล์ (ผ่าน Context Cache), auto = ใช้เมื่อข้อมูลยาวเกิน RETRIEVAL_AUTO_MIN_CHARS
+CONTEXT_RETRIEVAL = os.getenv("CONTEXT_RETRIEVAL", "auto").lower()
+RETRIEVAL_AUTO_MIN_CHARS = int(os.getenv("RETRIEVAL_AUTO_MIN_CHARS", "200000"))
+RETRIEVAL_EMBED_MODEL = os.getenv("RETRIEVAL_EMBED_MODEL", "models/text-embedding-004")
+RETRIEVAL_CHUNK_CHARS = 500 # ความยาวโดยประมาณของแต่ละส่วน (ตัวอักษร)
+RETRIEVAL_TOP_K = 5 # จำนวนส่วนที่แนบไปกับคำถาม
+EMBED_BATCH_SIZE = 100 # จำนวนข้อความสูงสุดต่อการเรียก embed_content 1 ครั้ง
+
+
+def split_into_chunks(text: str, chunk_chars: int = RETRIEVAL_CHUNK_CHARS) -> list[str]:
+    """แบ่งข้อความเป็นส่วนๆ ตามบรรทัด โดยแต่ละส่วนยาวไม่เกิน chunk_chars (ยกเว้นบรรทัดเดียวที่ยาวเกิน)"""
+    chunks = []
+    current = ""
+    for line in text.splitlines():
+        line = re.sub(r'\s+', ' ', line).strip()
+        if not line: continue
+        if current and len(current) + len(line) + 1 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class ContextRetriever:
+    """
+    เลือกเฉพาะส่วนของข้อมูลวิทยาลัยที่เกี่ยวข้องกับคำถาม (Top-K ตาม Cosine Similarity)
+    แทนการส่งข้อมูลทั้งไฟล์ไปกับทุกคำถาม เมื่อไฟล์ข้อมูลใหญ่เกินไป
+    """
+
+    def __init__(self, text: str, top_k: int = RETRIEVAL_TOP_K):
+        self.text = text
+        self.top_k = top_k
+        self.chunks: list[str] = []
+        self.chunk_vecs = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.chunk_vecs is not None
+
+    def should_enable(self) -> bool:
+        if CONTEXT_RETRIEVAL == "on": return True
+        if CONTEXT_RETRIEVAL == "auto": return len(self.text) >= RETRIEVAL_AUTO_MIN_CHARS
+        return False
+
+    def build(self) -> bool:
+        """แบ่งข้อมูลและคำนวณเวกเตอร์ทุกส่วนครั้งเดียวตอนเริ่มระบบ (ต้องตั้งค่า genai ด้วย API Key ก่อน)"""
+        if not self.should_enable():
+            return False
+        try:
+            chunks = split_into_chunks(self.text)
+            vecs = []
+            for i in range(0, len(chunks), EMBED_BATCH_SIZE):
+                result = genai.embed_content(
+                    model=RETRIEVAL_EMBED_MODEL,
+                    content=chunks[i:i + EMBED_BATCH_SIZE],
+                    task_type='retrieval_document'
+                )
+                vecs.extend(result['embedding'])
+            matrix = np.asarray(vecs, dtype=np.float32)
+            # Normalize เพื่อให้ dot product = cosine similarity
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            self.chunks = chunks
+            self.chunk_vecs = matrix
+            logger.info(f"Context retrieval enabled: {len(chunks)} chunks (top {self.top_k} per question)")
+            return True
+        except Exception as e:
+            logger.error(f"Error building context retrieval index: {e}. Sending full context instead.")
+            return False
+
+    async def retrieve(self, query: str) -> str:
+        """คืนข้อความเฉพาะส่วนที่เกี่ยวข้องกับคำถาม (เรียงตามลำดับในไฟล์) ถ้าค้นหาไม่ได้ คืนข้อมูลทั้งหมด"""
+        try:
+            result = await genai.embed_content_async(
+                model=RETRIEVAL_EMBED_MODEL, content=query, task_type='retrieval_query'
+            )
+            q = np.asarray(result['embedding'], dtype=np.float32)
+            scores = self.chunk_vecs @ q
+            k = min(self.top_k, len(self.chunks))
+            top = np.argpartition(-scores, k - 1)[:k]
+            return "\n\n".join(self.chunks[i] for i in sorted(top))
+        except Exception as e:
+            logger.error(f"Error retrieving context: {e}. Using full context.")
+            return self.text
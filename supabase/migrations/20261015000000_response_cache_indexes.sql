@@ -0,0 +1,13 @@
+-- Cache คำตอบ: 1 คำถามมีได้แถวเดียว (ให้ save_to_cache ใช้ UPSERT แทน INSERT ซ้ำ)
+-- ลบแถวซ้ำเดิมก่อน เก็บไว้แค่แถวล่าสุดของแต่ละคำถาม
+DELETE FROM response_cache a
+USING response_cache b
+WHERE a.user_message = b.user_message
+  AND (a.created_at < b.created_at
+       OR (a.created_at = b.created_at AND a.ctid < b.ctid)); -- เวลาเท่ากัน: เก็บไว้แถวเดียว ไม่ให้สร้าง Unique Index ไม่ผ่าน
+
+CREATE UNIQUE INDEX IF NOT EXISTS response_cache_msg_uniq ON response_cache (user_message);
+CREATE INDEX IF NOT EXISTS response_cache_created ON response_cache (created_at DESC);
+
+-- ประวัติแชท: ค้นหาตาม chat_id แล้วเรียงจากใหม่ -> เก่า
+CREATE INDEX IF NOT EXISTS chat_history_chat_created ON chat_history (chat_id, created_at DESC);
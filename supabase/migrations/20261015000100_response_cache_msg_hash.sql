@@ -0,0 +1,12 @@
+-- Cache คำตอบ: ค้นหาด้วย md5 ของข้อความมาตรฐาน (ดู normalize_message / message_hash ใน app.py)
+ALTER TABLE response_cache ADD COLUMN IF NOT EXISTS msg_hash CHAR(32);
+
+-- แถวเดิมไม่มี hash: คำนวณให้ตรงกับฝั่ง Python ไม่ได้ (casefold() + เวอร์ชันข้อมูลวิทยาลัย) จึงจะไม่มีวันถูกค้นเจอ
+-- ลบทิ้งแทนการเก็บข้อมูลที่ใช้ไม่ได้ไว้ (เป็นแค่ Cache อายุ 24 ชั่วโมง บอทจะสร้างคำตอบใหม่เอง)
+DELETE FROM response_cache WHERE msg_hash IS NULL;
+
+ALTER TABLE response_cache ALTER COLUMN msg_hash SET NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS response_cache_hash_uniq ON response_cache (msg_hash);
+
+-- ไม่ได้ค้นหาด้วย user_message แล้ว
+DROP INDEX IF EXISTS response_cache_msg_uniq;
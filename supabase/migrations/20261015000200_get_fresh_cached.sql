@@ -0,0 +1,30 @@
+-- ค้นหาคำตอบใน Cache ที่ยังไม่เก่าเกิน 24 ชั่วโมง (ให้ Postgres คำนวณเวลาตัดเอง)
+-- p_hash เป็น char(32) ชนิดเดียวกับ msg_hash: ถ้าเป็น text จะเทียบแบบ text และไม่ใช้ Unique Index (Scan ทั้งตาราง)
+DROP FUNCTION IF EXISTS get_fresh_cached(text);
+CREATE OR REPLACE FUNCTION get_fresh_cached(p_hash char(32))
+RETURNS text
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT bot_response
+    FROM response_cache
+    WHERE msg_hash = p_hash
+      AND created_at > now() - interval '24 hours'
+    LIMIT 1
+$$;
+
+-- เมื่อ UPSERT ทับคำตอบเดิม ให้นับอายุใหม่ (ไม่งั้นคำตอบที่เพิ่งอัปเดตจะถูกมองว่าเก่า)
+CREATE OR REPLACE FUNCTION response_cache_touch()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.created_at := now();
+    RETURN NEW;
+END
+$$;
+
+DROP TRIGGER IF EXISTS response_cache_touch ON response_cache;
+CREATE TRIGGER response_cache_touch
+BEFORE UPDATE ON response_cache
+FOR EACH ROW EXECUTE FUNCTION response_cache_touch();
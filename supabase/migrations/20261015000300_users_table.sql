@@ -0,0 +1,16 @@
+-- ชื่อผู้ใช้เก็บแยกในตาราง users (1 แถวต่อแชท) แทนการเก็บซ้ำในทุกแถวของ chat_history
+CREATE TABLE IF NOT EXISTS users (
+    chat_id TEXT PRIMARY KEY,
+    username TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- ย้ายชื่อล่าสุดของแต่ละแชทจาก chat_history
+INSERT INTO users (chat_id, username)
+SELECT DISTINCT ON (chat_id) chat_id, username
+FROM chat_history
+WHERE username IS NOT NULL
+ORDER BY chat_id, created_at DESC
+ON CONFLICT (chat_id) DO NOTHING;
+
+ALTER TABLE chat_history DROP COLUMN IF EXISTS username;
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# app.py หยุดทำงานถ้าไม่มี BOT_TOKEN: ใส่ค่าทดสอบไว้ก่อน import (ไม่ได้ต่อ Telegram จริง)
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(params=["ahocorasick", "regex"])
+def keyword_backend(request, monkeypatch):
+    """รัน Test เดียวกันทั้งแบบ Aho-Corasick และแบบ Regex (กรณีไม่ได้ติดตั้ง pyahocorasick)"""
+    import nvc_keywords
+    if request.param == "regex":
+        monkeypatch.setattr(nvc_keywords, "ahocorasick", None)
+    elif nvc_keywords.ahocorasick is None:
+        pytest.skip("pyahocorasick not installed")
+    return request.param
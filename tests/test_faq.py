@@ -0,0 +1,50 @@
+import pytest
+
+import app
+import nvc_keywords
+
+
+@pytest.fixture
+def faq(keyword_backend, monkeypatch):
+    """ทดสอบ match_faq ทั้งแบบ Aho-Corasick และแบบ Regex (กรณีไม่ได้ติดตั้ง pyahocorasick)"""
+    keywords = {kw: answer for keywords, answer in app.FAQ_ENTRIES for kw in keywords}
+    keywords.update({phrase: None for phrase in app.FAQ_BLOCKERS})
+    monkeypatch.setattr(app, "faq_matcher", nvc_keywords.KeywordMatcher(keywords))
+    return app.match_faq
+
+
+DIRECTOR_REPLY = "ผู้อำนวยการวิทยาลัยอาชีวศึกษานครศรีธรรมราช คือ นายสายันต์ แสงสุริยันต์ ครับ"
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("ผู้อำนวยการคือใคร", DIRECTOR_REPLY),
+    ("ใครคือผู้อำนวยการ", DIRECTOR_REPLY),
+    ("เบอร์โทร", app.CONTACT_REPLY),
+    ("ขอเบอร์โทรหน่อยครับ", app.CONTACT_REPLY),
+    ("โทรศัพท์วิทยาลัย", app.CONTACT_REPLY),
+    ("ที่อยู่วิทยาลัย", app.ADDRESS_REPLY),
+    ("  สวัสดีครับ ", app.FAQ_ENTRIES[0][1]),
+    ("HELLO", app.FAQ_ENTRIES[0][1]),
+])
+def test_faq_answers(faq, message, expected):
+    assert faq(message) == expected
+
+
+@pytest.mark.parametrize("message", [
+    # คีย์เวิร์ดเป็นส่วนหนึ่งของคำที่ยาวกว่า (ความหมายต่างกัน)
+    "รองผู้อำนวยการคือใคร",
+    "รองผู้อำนวยการฝ่ายวิชาการ",
+    "รอง ผอ. ชื่ออะไร",
+    "ห้ามใช้โทรศัพท์ไหม",
+    "เล่นโทรศัพท์ในห้องได้ไหม",
+    # หลายหัวข้อในข้อความเดียว
+    "สวัสดีครับ ขอเบอร์โทร",
+    # คีย์เวิร์ดสั้นเกินไปเมื่อเทียบกับข้อความ
+    "ขอบคุณที่แนะนำเรื่องการสมัครนะ",
+    # ข้อความยาวเกิน FAQ_MAX_MESSAGE_LENGTH
+    "สวัสดีครับ อยากทราบว่าแผนกเทคโนโลยีสารสนเทศเรียนอะไรบ้าง",
+    "",
+    "ค่าเทอมเท่าไหร่",
+])
+def test_faq_leaves_other_questions_to_gemini(faq, message):
+    assert faq(message) is None
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def local_store(monkeypatch):
+    """ใช้ประวัติใน Memory (ไม่มี Redis) และแยกข้อมูลของแต่ละ Test"""
+    monkeypatch.setattr(app, "redis_client", None)
+    monkeypatch.setattr(app, "local_history", app.defaultdict(lambda: app.deque(maxlen=app.HISTORY_MAX_ITEMS)))
+    return app.local_history
+
+
+@pytest.fixture
+def fake_supabase(monkeypatch):
+    """จำลองตาราง chat_history: คืนแถวเรียงใหม่ -> เก่า และนับจำนวนครั้งที่ถูกเรียก"""
+    calls = []
+    rows = [
+        {"sender": "bot", "message": "อาคาร 1 อยู่ด้านหน้าวิทยาลัยครับ"},
+        {"sender": "user", "message": "อาคาร 1 อยู่ไหน"},
+    ]
+
+    def _fetch(chat_id, limit):
+        calls.append((chat_id, limit))
+        return rows[:limit]
+
+    monkeypatch.setattr(app, "supabase", object())
+    monkeypatch.setattr(app, "_fetch_recent_chat_history", _fetch)
+    return calls
+
+
+def test_cold_chat_is_hydrated_from_supabase_once(local_store, fake_supabase):
+    history = asyncio.run(app.get_chat_history(42, limit=8))
+    assert history.index("[USER]: อาคาร 1 อยู่ไหน") < history.index("[BOT]: อาคาร 1 อยู่ด้านหน้าวิทยาลัยครับ")
+    assert [item['sender'] for item in local_store["42"]] == ["user", "bot"]
+
+    # ครั้งที่สองอ่านจาก Memory ที่เติมไว้แล้ว ไม่ถาม Supabase ซ้ำ
+    assert asyncio.run(app.get_chat_history(42, limit=8)) == history
+    assert len(fake_supabase) == 1
+
+
+def test_warm_chat_does_not_query_supabase(local_store, fake_supabase):
+    local_store["7"].append({"chat_id": "7", "sender": "user", "message": "สวัสดีครับ"})
+    assert "[USER]: สวัสดีครับ" in asyncio.run(app.get_chat_history(7))
+    assert fake_supabase == []
+
+
+def test_without_supabase_cold_chat_has_no_history(local_store, monkeypatch):
+    monkeypatch.setattr(app, "supabase", None)
+    assert asyncio.run(app.get_chat_history(99)) == ""
+
+
+class BrokenRedis:
+    """Redis ที่ต่อไม่ได้: ทุกคำสั่งโยน ConnectionError"""
+
+    async def lrange(self, *args):
+        raise app.redis.ConnectionError("redis down")
+
+    def pipeline(self, *args, **kwargs):
+        raise app.redis.ConnectionError("redis down")
+
+
+def test_redis_down_reads_in_process_history(local_store, monkeypatch):
+    monkeypatch.setattr(app, "supabase", None)
+    monkeypatch.setattr(app, "redis_client", BrokenRedis())
+    asyncio.run(app.save_chat_turn(5, [("user", "ห้อง 632 อยู่ไหน"), ("bot", "อยู่อาคาร 6 ครับ")]))
+    history = asyncio.run(app.get_chat_history(5))
+    assert "[USER]: ห้อง 632 อยู่ไหน" in history and "[BOT]: อยู่อาคาร 6 ครับ" in history
+
+
+def test_redis_down_cold_chat_is_hydrated_into_memory(local_store, fake_supabase, monkeypatch):
+    monkeypatch.setattr(app, "redis_client", BrokenRedis())
+    assert "[USER]: อาคาร 1 อยู่ไหน" in asyncio.run(app.get_chat_history(43))
+    assert [item['sender'] for item in local_store["43"]] == ["user", "bot"]
+    asyncio.run(app.get_chat_history(43))
+    assert len(fake_supabase) == 1
+
+
+def _add(store, chat_id, sender, message):
+    store[str(chat_id)].append({"chat_id": str(chat_id), "sender": sender, "message": message})
+
+
+def test_token_budget_keeps_newest_messages(local_store, monkeypatch):
+    monkeypatch.setattr(app, "supabase", None)
+    # แต่ละบรรทัด "[USER]: " + 32 ตัวอักษร = 40 ตัวอักษร = 10 Token -> งบ 25 Token พอแค่ 2 บรรทัด
+    monkeypatch.setattr(app, "HISTORY_TOKEN_BUDGET", 25)
+    for i in range(4):
+        _add(local_store, 1, "user", f"{i}" * 32)
+
+    history = asyncio.run(app.get_chat_history(1, limit=8))
+    assert "0" * 32 not in history and "1" * 32 not in history
+    assert history.index("2" * 32) < history.index("3" * 32)
+
+
+def test_history_whitespace_is_collapsed(local_store, monkeypatch):
+    monkeypatch.setattr(app, "supabase", None)
+    _add(local_store, 2, "user", "  อาคาร 1 \n\n  อยู่ไหน\t ")
+    assert "[USER]: อาคาร 1 อยู่ไหน\n" in asyncio.run(app.get_chat_history(2))
+
+
+def test_oversized_newest_message_is_truncated_not_dropped(local_store, monkeypatch):
+    monkeypatch.setattr(app, "supabase", None)
+    monkeypatch.setattr(app, "HISTORY_TOKEN_BUDGET", 50)
+    _add(local_store, 3, "user", "สั้นๆ")
+    _add(local_store, 3, "bot", "ก" * 3000)
+    # คำตอบล่าสุดยาวเกินงบ: ยังส่งส่วนต้นของคำตอบไป (ตัดให้พอดีงบ) แทนที่จะไม่มีประวัติเลย
+    history = asyncio.run(app.get_chat_history(3))
+    bot_line = next(line for line in history.splitlines() if line.startswith("[BOT]: "))
+    assert bot_line.startswith("[BOT]: ก") and bot_line.endswith("…")
+    assert app.estimate_tokens(bot_line) <= 50
+    assert "สั้นๆ" not in history
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", 0),
+    ("abcd", 1),
+    ("abcde", 2),
+    ("กขค", 2), # ภาษาไทย ~2 ตัวอักษร = 1 Token (ไม่ใช่ 4 ตัว)
+    ("ก" * 2048, 1024),
+])
+def test_estimate_tokens(text, expected):
+    assert app.estimate_tokens(text) == expected
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+import app
+
+
+def _manager(monkeypatch, key_count=3):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    for i in range(1, 10):
+        monkeypatch.delenv(f"GEMINI_API_KEY_{i}", raising=False)
+    manager = app.GeminiKeyManager(app.SYSTEM_INSTRUCTION, None)
+    manager.keys = [f"key-{i}" for i in range(key_count)]
+    configured_on = []
+    # ไม่เรียก Gemini จริง: บันทึกแค่ว่าถูกเรียกจาก Thread ไหน
+    manager._configure_current_key = lambda: configured_on.append(threading.get_ident())
+    return manager, configured_on
+
+
+def test_rotate_skips_when_failed_key_already_rotated(monkeypatch):
+    manager, _ = _manager(monkeypatch)
+    manager.rotate_key(failed_index=0)
+    assert manager.current_index == 1
+    # คำขออื่นที่เจอ 429 จาก Key 0 พร้อมกัน: ไม่สลับซ้ำ (ไม่ข้าม Key 1 ที่ยังไม่ได้ลอง)
+    manager.rotate_key(failed_index=0)
+    assert manager.current_index == 1
+
+
+def test_rotate_wraps_around(monkeypatch):
+    manager, _ = _manager(monkeypatch, key_count=2)
+    manager.rotate_key()
+    manager.rotate_key()
+    assert manager.current_index == 0
+
+
+def test_rotate_key_async_runs_off_the_event_loop(monkeypatch):
+    manager, configured_on = _manager(monkeypatch)
+    loop_thread = threading.get_ident()
+    asyncio.run(manager.rotate_key_async(0))
+    assert manager.current_index == 1
+    assert configured_on and configured_on[0] != loop_thread
+
+
+class _FakeManager:
+    def __init__(self, context_cached):
+        self.keys = ["key-0"]
+        self.context_cached = context_cached
+
+    def set_context_prompt(self, context_prompt):
+        pass
+
+
+def _started_threads(monkeypatch, context_cached, retrieval):
+    """รัน _init_gemini แล้วคืนรายการ target ของ Thread ที่ถูกสั่ง start"""
+    started = []
+
+    class _Thread:
+        def __init__(self, target, daemon):
+            self.target = target
+
+        def start(self):
+            started.append(self.target)
+
+    monkeypatch.setattr(app, "key_manager", app.key_manager) # คืนค่าเดิมหลังจบ Test
+    monkeypatch.setattr(app, "GeminiKeyManager", lambda *args: _FakeManager(context_cached))
+    monkeypatch.setattr(app.context_retriever, "build", lambda: retrieval)
+    monkeypatch.setattr(app.threading, "Thread", _Thread)
+    app._init_gemini()
+    return started
+
+
+def test_refresh_thread_starts_only_with_context_cache(monkeypatch):
+    assert _started_threads(monkeypatch, context_cached=True, retrieval=False) == [app._context_cache_refresh_loop]
+    # โหมด Retrieval หรือสร้าง Cache ไม่ได้: ไม่มี Cache ให้ต่ออายุ
+    assert _started_threads(monkeypatch, context_cached=False, retrieval=True) == []
+    assert _started_threads(monkeypatch, context_cached=False, retrieval=False) == []
@@ -0,0 +1,78 @@
+import pytest
+
+import app
+from nvc_keywords import KeywordMatcher
+
+
+def test_find_longest_prefers_the_longest_overlapping_keyword(keyword_backend):
+    matcher = KeywordMatcher({"แผนกการจัดการธุรกิจ": "business", "แผนกการจัดการธุรกิจท่องเที่ยว": "tourism"})
+    assert matcher.find_longest("ครูแผนกการจัดการธุรกิจท่องเที่ยว") == [("แผนกการจัดการธุรกิจท่องเที่ยว", "tourism")]
+
+
+def test_find_longest_prefers_the_leftmost_of_overlapping_keywords(keyword_backend):
+    matcher = KeywordMatcher({"abc": 1, "cdefg": 2})
+    assert matcher.find_longest("xabcdefg") == [("abc", 1)]
+
+
+def test_find_longest_keeps_separate_matches_in_order(keyword_backend):
+    matcher = KeywordMatcher({"แผนที่": "map", "อาคาร 2": "b2"})
+    assert matcher.find_longest("แผนที่ และ อาคาร 2") == [("แผนที่", "map"), ("อาคาร 2", "b2")]
+
+
+def test_matching_is_case_insensitive(keyword_backend):
+    matcher = KeywordMatcher({"Hello": "hi"})
+    assert matcher.find_all("HELLO there") == [("hello", "hi")]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("อาคาร 1", [("อาคาร 1", 1)]),
+    ("อาคาร 1 อยู่ไหน", [("อาคาร 1", 1)]),
+    ("อาคาร 1, อาคาร 2", [("อาคาร 1", 1)]),
+    ("อาคาร 10", []),
+    ("อาคาร 12 ชั้น 3", []),
+])
+def test_keyword_ending_in_digit_needs_a_digit_boundary(keyword_backend, text, expected):
+    matcher = KeywordMatcher({"อาคาร 1": 1})
+    assert matcher.find_all(text) == expected
+    assert matcher.find_longest(text) == expected
+
+
+def test_empty_matcher_finds_nothing(keyword_backend):
+    assert KeywordMatcher({}).find_longest("อะไรก็ได้") == []
+
+
+@pytest.fixture
+def image_matcher(keyword_backend, monkeypatch):
+    monkeypatch.setattr(app, "image_matcher", app._build_image_matcher())
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("อาคาร 1 อยู่ไหน", "building_1"),
+    ("อาคาร1", "building_1"),
+    ("อาคาร 10 อยู่ไหน", None), # มีแค่อาคาร 1-8
+    ("ห้อง 632 อยู่ตึกไหน", "building_6_632"),
+    ("ห้อง 6321", None),
+    ("ครูแผนกการจัดการธุรกิจท่องเที่ยว", "DeoTBM"),
+    ("ครูแผนกการจัดการโลจิสติกส์และซัพพลายเชน", "DeoLaSCM"),
+    ("บุคลากรแผนกวิชาการจัดการโลจิสติกส์และซัพพลายเซน", "DeoLaSCM"),
+    ("แผนที่ กับ อาคาร 2", None), # หลายหัวข้อ ไม่ส่งรูป
+    ("📝 การรับสมัครปวช./ปวส.", "quota_round_2"), # ปุ่มเมนูลัด (ไม่มีใน BUTTON_REPLIES จึงเลือกรูปจากข้อความ)
+    ("การรับสมัครปริญญาตรี", "QU"),
+    ("นักศึกษาใหม่ ปวช. และ ปวส. รอบโควตาพิเศษ", "quota_round_1"),
+    ("โควตาพิเศษ", "quota_round_1"),
+    ("การรับสมัคร โควตากรณีพิเศษ", "quota_round_2"),
+])
+def test_match_image_tag(image_matcher, message, expected):
+    assert app.match_image_tag(message) == expected
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("แผนที่", "map"),
+    ("ขอผังอาคาร", "pang"),
+    ("อาคาร1", "building_1"),
+    ("อาคาร 10", None),
+    ("ห้อง 6321", None),
+    ("อาคาร 1 อยู่ไหน", None), # เป็นคำถาม ให้ Gemini ตอบ
+])
+def test_match_image_shortcut(image_matcher, message, expected):
+    assert app.match_image_shortcut(message) == expected
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+import nvc_cache
+
+DIM = 8
+WORDS = ["a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+class FakeEmbedder:
+    """จำลองโมเดล Embedding: แต่ละคำได้เวกเตอร์ One-hot ของตัวเอง (คำต่างกัน = ไม่คล้ายกันเลย)"""
+
+    def __init__(self):
+        self.encoded_on = []
+
+    def get_sentence_embedding_dimension(self):
+        return DIM
+
+    def encode(self, text, normalize_embeddings=True):
+        self.encoded_on.append(threading.get_ident())
+        vec = np.zeros(DIM, dtype=np.float32)
+        vec[WORDS.index(text)] = 1.0
+        return vec
+
+
+@pytest.fixture(params=["hnsw", "brute-force"])
+def make_cache(request, monkeypatch):
+    if request.param == "hnsw":
+        if nvc_cache.hnswlib is None:
+            pytest.skip("hnswlib not installed")
+        monkeypatch.setattr(nvc_cache, "SEMANTIC_CACHE_HNSW_MIN_ENTRIES", 0) # ใช้ HNSW ตั้งแต่รายการแรก
+    else:
+        monkeypatch.setattr(nvc_cache, "hnswlib", None)
+
+    def _make(max_entries=3, ttl=3600):
+        embedder = FakeEmbedder()
+        monkeypatch.setattr(nvc_cache, "load_embedding_model", lambda name: embedder)
+        cache = nvc_cache.SemanticCache(threshold=0.9, ttl=ttl, max_entries=max_entries)
+        cache.load()
+        return cache
+    return _make
+
+
+def test_hit_and_miss(make_cache):
+    cache = make_cache()
+    cache.add("a", "answer-a")
+    answer, vec = cache.lookup("a")
+    assert answer == "answer-a"
+    assert vec.shape == (DIM,)
+    assert cache.lookup("b")[0] is None
+
+
+def test_full_cache_overwrites_oldest(make_cache):
+    cache = make_cache(max_entries=3)
+    for word in "abcd":
+        cache.add(word, f"answer-{word}")
+
+    assert cache.size == 3
+    assert cache.cache_vecs.shape == (3, DIM) # ไม่โตเกินที่จองไว้
+    assert cache.lookup("a")[0] is None # รายการเก่าสุดถูกเขียนทับแล้ว
+    for word in "bcd":
+        assert cache.lookup(word)[0] == f"answer-{word}"
+    if cache.index is not None:
+        # label คือลำดับที่เพิ่ม: label 0 ("a") ถูกแทนที่ด้วย label 3 ("d")
+        assert sorted(cache.index.get_ids_list()) == [1, 2, 3]
+
+
+def test_many_wraparounds_keep_labels_and_rows_in_sync(make_cache):
+    cache = make_cache(max_entries=3)
+    for i in range(30):
+        word = WORDS[i % len(WORDS)]
+        cache.add(word, f"answer-{i}")
+    # 3 รายการล่าสุดคือ i = 27, 28, 29 -> คำ "d", "e", "f"
+    assert cache.lookup("f")[0] == "answer-29"
+    assert cache.lookup("d")[0] == "answer-27"
+    assert cache.lookup("c")[0] is None
+    if cache.index is not None:
+        assert sorted(cache.index.get_ids_list()) == [27, 28, 29]
+
+
+def test_expired_entries_are_skipped(make_cache, monkeypatch):
+    cache = make_cache(ttl=10)
+    now = 1_000_000.0
+    monkeypatch.setattr(nvc_cache.time, "time", lambda: now)
+    cache.add("a", "answer-a")
+    now += 11
+    assert cache.lookup("a")[0] is None
+
+
+def test_async_wrappers_run_off_the_event_loop(make_cache):
+    cache = make_cache()
+
+    async def _run():
+        await cache.add_async("a", "answer-a")
+        return await cache.lookup_async("a")
+
+    loop_thread = threading.get_ident()
+    answer, _ = asyncio.run(_run())
+    assert answer == "answer-a"
+    assert loop_thread not in cache.model.encoded_on
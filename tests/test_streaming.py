@@ -0,0 +1,83 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+import app
+
+
+class FakeModel:
+    """จำลอง Gemini: ส่งข้อความทีละส่วน โดยพักตามเวลาที่กำหนดก่อนแต่ละส่วน"""
+
+    def __init__(self, parts: list[tuple[float, str]]):
+        self.parts = parts
+
+    async def generate_content_async(self, contents, stream=False, request_options=None):
+        async def _stream():
+            for delay, text in self.parts:
+                await asyncio.sleep(delay)
+                yield SimpleNamespace(text=text)
+        return _stream()
+
+
+@pytest.fixture
+def fast_timeouts(monkeypatch):
+    monkeypatch.setattr(app, "GEMINI_TIMEOUT_SECONDS", 0.2)
+    monkeypatch.setattr(app, "GEMINI_STREAM_IDLE_SECONDS", 0.2)
+    monkeypatch.setattr(app, "STREAM_EDIT_INTERVAL", 0)
+    monkeypatch.setattr(app, "STREAM_EDIT_MIN_CHARS", 1)
+
+
+def _context():
+    return SimpleNamespace(bot=SimpleNamespace(edit_message_text=AsyncMock()))
+
+
+def _run(model, context=None):
+    return asyncio.run(app.stream_gemini_reply(model, ["q"], context or _context(), 1, 10))
+
+
+def test_long_steady_stream_is_not_cut_off(fast_timeouts):
+    # ใช้เวลารวมนานกว่า GEMINI_TIMEOUT_SECONDS แต่ไม่มีช่วงไหนเงียบเกินกำหนด
+    model = FakeModel([(0.1, f"part{i} ") for i in range(6)])
+    assert _run(model) == " ".join(f"part{i}" for i in range(6))
+
+
+def test_no_first_chunk_raises_timeout(fast_timeouts):
+    with pytest.raises(asyncio.TimeoutError):
+        _run(FakeModel([(1.0, "late")]))
+
+
+def test_stall_after_partial_text_keeps_it(fast_timeouts):
+    context = _context()
+    with pytest.raises(app.GeminiStreamStalled) as excinfo:
+        _run(FakeModel([(0.05, "ข้อความส่วนแรก"), (1.0, "ไม่มาถึง")]), context)
+    assert excinfo.value.partial_text == "ข้อความส่วนแรก"
+    context.bot.edit_message_text.assert_awaited()
+
+
+def test_telegram_rate_limit_during_stream_keeps_the_answer(fast_timeouts):
+    context = _context()
+    context.bot.edit_message_text.side_effect = [RetryAfter(30), None, None]
+    model = FakeModel([(0.01, "ส่วนที่ 1 "), (0.01, "ส่วนที่ 2 "), (0.01, "ส่วนที่ 3")])
+    assert _run(model, context) == "ส่วนที่ 1 ส่วนที่ 2 ส่วนที่ 3"
+    # หลังโดน Rate Limit งดแก้ไขระหว่างทาง (ไม่ยิงคำขอถี่ๆ ใส่ Telegram)
+    assert context.bot.edit_message_text.await_count == 1
+
+
+def test_telegram_bad_request_during_stream_is_skipped(fast_timeouts):
+    context = _context()
+    context.bot.edit_message_text.side_effect = [BadRequest("Message to edit not found"), None, None]
+    model = FakeModel([(0.01, "ส่วนที่ 1 "), (0.01, "ส่วนที่ 2 "), (0.01, "ส่วนที่ 3")])
+    assert _run(model, context) == "ส่วนที่ 1 ส่วนที่ 2 ส่วนที่ 3"
+    assert context.bot.edit_message_text.await_count == 3
+
+
+def test_final_edit_waits_out_rate_limit(monkeypatch):
+    monkeypatch.setattr(app.asyncio, "sleep", AsyncMock())
+    context = _context()
+    context.bot.edit_message_text.side_effect = [RetryAfter(2), None]
+    asyncio.run(app.edit_final_reply(context, 1, 10, "คำตอบ"))
+    app.asyncio.sleep.assert_awaited_once_with(2.0)
+    assert context.bot.edit_message_text.await_count == 2
@@ -0,0 +1,56 @@
+"""
+สคริปต์อัปโหลดรูปใน IMAGE_SOURCES ขึ้น Telegram ครั้งเดียว แล้วเก็บ file_id ไว้ใน image_file_ids.json
+หลังจากนั้นบอทจะส่งรูปด้วย file_id (Telegram ไม่ต้องดาวน์โหลดรูปจาก Supabase ใหม่ทุกครั้ง)
+รันใหม่เมื่อเพิ่ม/เปลี่ยนรูป (ผ่าน `make image-ids`) รูปที่มี file_id อยู่แล้วจะถูกข้าม
+
+วิธีใช้: BOT_TOKEN=... ADMIN_CHAT_ID=... python tools/bootstrap_image_ids.py [image_file_ids.json]
+(ADMIN_CHAT_ID คือแชทที่ใช้รับรูปตอนอัปโหลด รูปจะถูกลบออกจากแชทหลังได้ file_id แล้ว)
+"""
+import os
+import sys
+import json
+import asyncio
+from dotenv import load_dotenv
+from telegram import Bot
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nvc_images import IMAGE_SOURCES, load_file_ids
+
+
+def all_image_urls() -> list[str]:
+    """รวม URL รูปทั้งหมดใน IMAGE_SOURCES (ไม่ซ้ำ เรียงตามลำดับที่เจอ)"""
+    urls = []
+    for image_data, _ in IMAGE_SOURCES.values():
+        for url in (image_data if isinstance(image_data, list) else [image_data]):
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+async def upload_images(bot: Bot, chat_id: str, file_ids: dict[str, str]) -> dict[str, str]:
+    """อัปโหลดรูปที่ยังไม่มี file_id แล้วคืนตาราง URL -> file_id ที่อัปเดตแล้ว"""
+    async with bot:
+        for url in all_image_urls():
+            if url in file_ids: continue
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=url, disable_notification=True)
+                file_ids[url] = message.photo[-1].file_id
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+                print(f"Uploaded {url}")
+            except Exception as e:
+                print(f"Error uploading {url}: {e}")
+    return file_ids
+
+
+def main():
+    load_dotenv()
+    output_path = sys.argv[1] if len(sys.argv) > 1 else "image_file_ids.json"
+
+    file_ids = asyncio.run(upload_images(Bot(os.environ["BOT_TOKEN"]), os.environ["ADMIN_CHAT_ID"], load_file_ids(output_path)))
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(file_ids, f, ensure_ascii=False, indent=2)
+    print(f"Saved {len(file_ids)} file_ids -> {output_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+สคริปต์ Export โมเดล Embedding ของ Semantic Cache เป็น ONNX แล้วบีบอัดเป็น int8 (Dynamic Quantization)
+ทำให้ Embed คำถามเร็วขึ้นหลายเท่าและใช้ RAM น้อยลง โดยที่บน Server จริงติดตั้งแค่ onnxruntime + tokenizers
+รันครั้งเดียว (ผ่าน `make embedding-model`) แล้วนำโฟลเดอร์ onnx_model/ ขึ้น Server ไปด้วย
+
+วิธีใช้: pip install -r requirements-dev.txt && python tools/export_onnx.py [ชื่อโมเดล] [onnx_model]
+"""
+import os
+import sys
+from optimum.exporters.onnx import main_export
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+
+def export_int8(model_name: str, output_dir: str) -> str:
+    """Export โมเดลเป็น model.onnx (พร้อม tokenizer.json) แล้วสร้าง model.int8.onnx ในโฟลเดอร์เดียวกัน"""
+    main_export(model_name, output=output_dir, task='feature-extraction')
+    fp32_path = os.path.join(output_dir, "model.onnx")
+    int8_path = os.path.join(output_dir, "model.int8.onnx")
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+def main():
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else "onnx_model"
+
+    int8_path = export_int8(model_name, output_dir)
+    size_mb = os.path.getsize(int8_path) / (1024 * 1024)
+    print(f"Exported {model_name} -> {int8_path} ({size_mb:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+สคริปต์แปลงไฟล์ PDF ข้อมูลวิทยาลัย (dataNVC.pdf) เป็นไฟล์ข้อความ (dataNVC.txt)
+รันครั้งเดียวตอนข้อมูลเปลี่ยน (ผ่าน `make context`) แล้ว commit ไฟล์ .txt ไว้ในโปรเจกต์
+ตัวบอทจะอ่านแค่ไฟล์ .txt จึงไม่ต้องติดตั้ง pypdf บน Server จริง
+ถ้า PDF ไม่ได้เปลี่ยน (hash ตรงกับครั้งก่อน) จะข้ามการแปลงไปเลย
+ถ้าไม่มีไฟล์ PDF หรือมีไฟล์ .txt อยู่แล้วแต่ไม่รู้ว่าสร้างจาก PDF ไหน (เช่น เพิ่ง clone มา) จะไม่เขียนทับไฟล์ .txt
+ที่ตรวจแก้ด้วยมือไว้แล้ว ยกเว้นสั่ง --force
+
+วิธีใช้: pip install pypdf && python tools/extract_pdf.py [--force] [dataNVC.pdf] [dataNVC.txt]
+"""
+import os
+import sys
+import hashlib
+
+
+def file_md5(path: str) -> str:
+    """คำนวณ MD5 ของไฟล์ (อ่านทีละส่วน ไม่ต้องโหลดทั้งไฟล์เข้า Memory)"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extract_pdf_text(pdf_path: str) -> str:
+    """ดึงข้อความจากทุกหน้าของ PDF มาต่อกัน (pypdf เร็วกว่า pdfplumber มาก เพราะไม่ต้องวิเคราะห์ Layout)"""
+    # Import เฉพาะตอนต้องแปลงจริง (ถ้า PDF ไม่เปลี่ยน จะไม่ต้อง import เลย)
+    from pypdf import PdfReader
+    return "\n".join(page.extract_text() or "" for page in PdfReader(pdf_path).pages)
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != "--force"]
+    force = "--force" in sys.argv[1:]
+    pdf_path = args[0] if len(args) > 0 else "dataNVC.pdf"
+    txt_path = args[1] if len(args) > 1 else "dataNVC.txt"
+    # เก็บ hash ของ PDF ที่ใช้สร้างไฟล์ .txt ล่าสุด (ไฟล์เฉพาะเครื่อง อยู่ใน .gitignore)
+    hash_path = f"{txt_path}.md5"
+
+    if not os.path.exists(pdf_path):
+        print(f"{pdf_path} not found. Keeping existing {txt_path}.")
+        return
+
+    pdf_hash = file_md5(pdf_path)
+    if os.path.exists(txt_path) and not force:
+        if not os.path.exists(hash_path):
+            print(f"{txt_path} exists but was not extracted on this machine. "
+                  f"Not overwriting it; run with --force to re-extract from {pdf_path}.")
+            return
+        with open(hash_path, 'r', encoding='utf-8') as f:
+            if f.read().strip() == pdf_hash:
+                print(f"{pdf_path} unchanged (md5 {pdf_hash}). Skipping extraction.")
+                return
+
+    text = extract_pdf_text(pdf_path)
+    with open(txt_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    with open(hash_path, 'w', encoding='utf-8') as f:
+        f.write(pdf_hash)
+    print(f"Extracted {len(text)} characters from {pdf_path} -> {txt_path}")
+
+
+if __name__ == '__main__':
+    main()